@@ -5,28 +5,64 @@ primarily with communication to/from the API's users."""
 
 
 import logging
+import time
+from bisect import bisect_right
 import endpoints
 from protorpc import remote, messages
+from google.appengine.api import datastore_errors
 from google.appengine.api import memcache
+from google.appengine.api import oauth
 from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
 
-from models import User, Game, Score
-from models import StringMessage, NewGameForm, GameForm, MakeMoveForm,\
-    ScoreForms, GameForms, RankingForm, RankingForms, HistoryForm
-from utils import get_by_urlsafe
+import bulk
+import counters
+import hints
+import instrumentation
+from models import User, Game, Score, DailyScore, Leaderboard, ACTIVE_GAMES,\
+    ATTEMPTS_REMAINING, LEADERBOARD_SIZE, StaleMoveError, prefetch_user_names
+from models import StringMessage, NewGameForm, NewGamesForm, GameForm,\
+    MakeMoveForm, MakeMovesForm, MovesForm, ScoreForms, GameForms,\
+    RankingForm, RankingForms, HistoryForm, HintForm, UserStatsForm,\
+    StatsForm, StatsForms
+from instrumentation import instrumented
+from utils import get_by_urlsafe, get_by_urlsafe_async, get_key, fetch_page
 
 NEW_GAME_REQUEST = endpoints.ResourceContainer(NewGameForm)
+NEW_GAMES_REQUEST = endpoints.ResourceContainer(NewGamesForm)
 GET_GAME_REQUEST = endpoints.ResourceContainer(
         urlsafe_game_key=messages.StringField(1),)
 MAKE_MOVE_REQUEST = endpoints.ResourceContainer(
     MakeMoveForm,
     urlsafe_game_key=messages.StringField(1),)
+MAKE_MOVES_REQUEST = endpoints.ResourceContainer(
+    MakeMovesForm,
+    urlsafe_game_key=messages.StringField(1),)
 USER_REQUEST = endpoints.ResourceContainer(user_name=messages.StringField(1),
                                            email=messages.StringField(2))
+USER_GAMES_REQUEST = endpoints.ResourceContainer(
+    user_name=messages.StringField(1),
+    page_size=messages.IntegerField(2),
+    cursor=messages.StringField(3))
+IMPORT_REQUEST = endpoints.ResourceContainer(
+    export_id=messages.StringField(1, required=True))
+USER_STATS_REQUEST = endpoints.ResourceContainer(
+    user_name=messages.StringField(1))
+PAGE_REQUEST = endpoints.ResourceContainer(
+    page_size=messages.IntegerField(1),
+    cursor=messages.StringField(2))
 LIST_REQUEST = endpoints.ResourceContainer(
     number_of_results=messages.IntegerField(1))
+RANKING_REQUEST = endpoints.ResourceContainer(
+    number_of_results=messages.IntegerField(1),
+    cursor=messages.StringField(2))
 
 MEMCACHE_MOVES_REMAINING = 'MOVES_REMAINING'
+# The cached average is refreshed at most once per window (in seconds)
+AVERAGE_ATTEMPTS_WINDOW = 10
+DEFAULT_PAGE_SIZE = 20
+MAX_NEW_GAMES = 500
+MAX_PAGE_SIZE = 100
 
 
 @endpoints.api(name='hangman', version='v1')
@@ -37,6 +73,7 @@ class HangmanApi(remote.Service):
                       path='user',
                       name='create_user',
                       http_method='POST')
+    @instrumented('create_user')
     def create_user(self, request):
         """Create a User. Requires a unique username"""
         if User.query(User.name == request.user_name).get():
@@ -52,6 +89,7 @@ class HangmanApi(remote.Service):
                       path='game',
                       name='new_game',
                       http_method='POST')
+    @instrumented('new_game')
     def new_game(self, request):
         """Creates new game"""
         user = User.query(User.name == request.user_name).get()
@@ -59,7 +97,7 @@ class HangmanApi(remote.Service):
             raise endpoints.NotFoundException(
                     'A User with that name does not exist!')
         try:
-            game = Game.new_game(user.key, request.answer_word,
+            game = Game.new_game(user, request.answer_word,
                                  request.attempts)
         except ValueError:
             raise endpoints.BadRequestException('Answer must be more '
@@ -68,19 +106,53 @@ class HangmanApi(remote.Service):
         # Use a task queue to update the average attempts remaining.
         # This operation is not needed to complete the creation of a new game
         # so it is performed out of sequence.
-        taskqueue.add(url='/tasks/cache_average_attempts')
+        self._schedule_average_attempts()
         return game.to_form('Good luck playing Hangman!')
 
+    @endpoints.method(request_message=NEW_GAMES_REQUEST,
+                      response_message=GameForms,
+                      path='games',
+                      name='new_games',
+                      http_method='POST')
+    @instrumented('new_games')
+    def new_games(self, request):
+        """Creates a batch of new games. No games are created if any
+        request in the batch is invalid"""
+        if len(request.games) > MAX_NEW_GAMES:
+            raise endpoints.BadRequestException(
+                    'At most {} games can be created at once!'.format(
+                        MAX_NEW_GAMES))
+        users = User.get_by_names(form.user_name for form in request.games)
+        missing = sorted(set(form.user_name for form in request.games
+                             if form.user_name not in users))
+        if missing:
+            raise endpoints.NotFoundException(
+                    'No Users with the names: {}'.format(', '.join(missing)))
+        try:
+            games = Game.new_games([(users[form.user_name], form.answer_word,
+                                     form.attempts)
+                                    for form in request.games])
+        except ValueError:
+            raise endpoints.BadRequestException('Answer must be more '
+                                                'than one letter!')
+        # One refresh of the average attempts covers the whole batch
+        self._schedule_average_attempts()
+        return GameForms(items=[game.to_form('Good luck playing Hangman!')
+                                for game in games])
+
     @endpoints.method(request_message=GET_GAME_REQUEST,
                       response_message=GameForm,
                       path='game/{urlsafe_game_key}',
                       name='get_game',
                       http_method='GET')
+    @instrumented('get_game')
+    @ndb.synctasklet
     def get_game(self, request):
         """Return the current game state."""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
+        game = yield get_by_urlsafe_async(request.urlsafe_game_key, Game)
         if game:
-            return game.to_form('Time to make a move!')
+            yield game.get_user_name_async()
+            raise ndb.Return(game.to_form('Time to make a move!'))
         else:
             raise endpoints.NotFoundException('Game not found!')
 
@@ -89,159 +161,360 @@ class HangmanApi(remote.Service):
                       path='game/{urlsafe_game_key}',
                       name='make_move',
                       http_method='PUT')
+    @instrumented('make_move')
+    @ndb.synctasklet
     def make_move(self, request):
-        """Makes a move. Returns a game state with message"""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
+        """Makes a move. Returns a game state with message. A request sent
+        again with the same idempotency_key returns the first response
+        without guessing again; with move_seq, the move is refused if the
+        game has changed since"""
+        game, results = yield self._update_game_async(
+            request.urlsafe_game_key,
+            lambda game: [game.make_guess(request.guess)],
+            request.idempotency_key, request.move_seq)
+        raise ndb.Return(game.to_form(results[0]))
 
-        if game.game_over:
-            return game.to_form('Game already over!')
-        # if a guess has already been made, the user will be alerted
-        # and will not be penalized a guess
-        if request.guess in game.prev_guesses:
-            return game.to_form('You already guessed ' + request.guess)
-        # user can enter either a letter or a word into the guess field.
-        # if letter, check to see if letter is in word or not.
-        # if word, check to see if word matches answer.
-        if len(request.guess) == 0:
+    @endpoints.method(request_message=MAKE_MOVES_REQUEST,
+                      response_message=MovesForm,
+                      path='game/{urlsafe_game_key}/moves',
+                      name='make_moves',
+                      http_method='PUT')
+    @instrumented('make_moves')
+    @ndb.synctasklet
+    def make_moves(self, request):
+        """Makes a sequence of moves, stopping once the game is over.
+        Returns the final game state and the message for each move made"""
+        if not all(request.guesses):
             raise endpoints.BadRequestException('Guess cannot be '
                                                 'blank!')
-        elif len(request.guess) == 1:
-            # if letter guess is successful, show successful guesses
-            # in guess_field
-            if request.guess in game.answer:
-                i = 0
-                new_guess_field = ''
-                while i < len(game.answer):
-                    if request.guess == game.answer[i]:
-                        new_guess_field += request.guess
-                    elif game.guess_field[i] == '*':
-                        new_guess_field += '*'
-                    else:
-                        new_guess_field += game.guess_field[i]
-                    i += 1
-                game.update_guess_field(new_guess_field)
-                # if there are no more *'s, then the word has been guessed
-                if '*' in new_guess_field:
-                    msg = 'You got one! Keep guessing: ' + new_guess_field
-                    game.add_to_guesslist(request.guess)
-                else:
-                    msg = 'You win! The answer is: ' + new_guess_field
-                    game.end_game(True)
-            else:
-                msg = 'Nope! ' + request.guess + ' is not in the answer. ' \
-                      'Keep guessing: ' + game.guess_field
-                game.add_to_guesslist(request.guess)
-                game.attempts_remaining -= 1
-        else:
-            if request.guess == game.answer:
-                msg = 'Hooray! You win! The answer is: ' + game.answer
-                game.end_game(True)
-            else:
-                msg = 'Nope! ' + request.guess + ' is not the answer. ' \
-                      'Keep guessing: ' + game.guess_field
-                game.add_to_guesslist(request.guess)
-                game.attempts_remaining -= 1
-
-        if game.attempts_remaining < 1:
-            game.end_game(False)
-            return game.to_form('Game over!')
-        else:
-            game.put()
-            return game.to_form(msg)
 
-    @endpoints.method(response_message=ScoreForms,
+        def play(game):
+            results = []
+            for guess in request.guesses:
+                results.append(game.make_guess(guess))
+                if game.game_over:
+                    break
+            return results
+        # The game is read once and written once for the whole sequence
+        game, results = yield self._update_game_async(
+            request.urlsafe_game_key, play, request.idempotency_key,
+            request.move_seq)
+        raise ndb.Return(MovesForm(
+            game=game.to_form(results[-1] if results else
+                              'Time to make a move!'),
+            results=results))
+
+    @endpoints.method(request_message=PAGE_REQUEST,
+                      response_message=ScoreForms,
                       path='scores',
                       name='get_scores',
                       http_method='GET')
+    @instrumented('get_scores')
     def get_scores(self, request):
-        """Return all scores"""
-        return ScoreForms(items=[score.to_form() for score in Score.query()])
+        """Return a page of scores"""
+        scores, next_cursor = fetch_page(Score.query(),
+                                         _page_size(request.page_size),
+                                         request.cursor)
+        prefetch_user_names(scores)
+        return ScoreForms(items=[score.to_form() for score in scores],
+                          next_cursor=next_cursor)
 
     @endpoints.method(response_message=StringMessage,
                       path='games/average_attempts',
                       name='get_average_attempts_remaining',
                       http_method='GET')
+    @instrumented('get_average_attempts_remaining')
     def get_average_attempts(self, request):
         """Get the cached average moves remaining"""
         return StringMessage(message=memcache.get(
             MEMCACHE_MOVES_REMAINING) or '')
 
-    @endpoints.method(request_message=USER_REQUEST,
+    @endpoints.method(request_message=USER_GAMES_REQUEST,
                       response_message=GameForms,
                       path='games/user/{user_name}',
                       name='get_user_games',
                       http_method='GET')
+    @instrumented('get_user_games')
     def get_user_games(self, request):
-        """Get all active games for a user"""
+        """Get a page of active games for a user"""
         user = User.query(User.name == request.user_name).get()
         if not user:
             raise endpoints.NotFoundException(
                     'A User with that name does not exist!')
-        games = Game.query(Game.user == user.key, Game.game_over == False)
-        return GameForms(items=[game.to_form('temp') for game in games])
+        # The User keeps its active game keys in key order, so a page is one
+        # get_multi. The cursor is the last key of the previous page; paging
+        # resumes after it even if games have been added or removed since
+        cursor = _key_cursor(request.cursor)
+        start = bisect_right(user.active_games, cursor) if cursor else 0
+        end = start + _page_size(request.page_size)
+        keys = user.active_games[start:end]
+        games = [game for game in ndb.get_multi(keys) if game]
+        ended = [game.key for game in games if game.game_over]
+        if ended:
+            # Left behind by a game whose end failed to update the User
+            User.remove_active_games(user.key, ended)
+        games = [game for game in games if not game.game_over]
+        for game in games:
+            game.user_name = game.user_name or user.name
+        next_cursor = keys[-1].urlsafe() \
+            if end < len(user.active_games) else None
+        return GameForms(items=[game.to_form('temp') for game in games],
+                         next_cursor=next_cursor)
 
     @endpoints.method(request_message=GET_GAME_REQUEST,
                       response_message=GameForm,
                       path='game/cancel/{urlsafe_game_key}',
                       name='cancel_game',
                       http_method='PUT')
+    @instrumented('cancel_game')
     def cancel_game(self, request):
         """Cancel a game"""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
-        if game.game_over:
-            msg = 'This game is already over.'
-        else:
+        def cancel(game):
+            if game.game_over:
+                return ['This game is already over.']
             game.cancel_game()
-            msg = 'GAME CANCELLED!'
-        return game.to_form(msg)
+            return ['GAME CANCELLED!']
+        game, results = self._update_game_async(
+            request.urlsafe_game_key, cancel).get_result()
+        return game.to_form(results[0])
 
     @endpoints.method(request_message=LIST_REQUEST,
                       response_message=ScoreForms,
                       path='leaderboard',
                       name='get_high_scores',
                       http_method='GET')
+    @instrumented('get_high_scores')
     def get_high_scores(self, request):
-        """Return all scores from highest to lowest"""
-        maxScores = request.number_of_results
-        scores = Score.query().order(Score.guesses).fetch(maxScores)
-        return ScoreForms(items=[score.to_form() for score in scores])
+        """Return the best scores, fewest guesses first"""
+        maxScores = request.number_of_results or LEADERBOARD_SIZE
+        entries = Leaderboard.get_entries()
+        if entries is None:
+            # The leaderboard is rebuilt off the serving path
+            Leaderboard.schedule_rebuild()
+            entries = []
+        return ScoreForms(items=[Leaderboard.to_form(entry)
+                                 for entry in entries[:maxScores]])
 
-    @endpoints.method(request_message=LIST_REQUEST,
+    @endpoints.method(request_message=RANKING_REQUEST,
                       response_message=RankingForms,
                       path='ranking',
                       name='get_user_rankings',
                       http_method='GET')
+    @instrumented('get_user_rankings')
     def get_user_rankings(self, request):
-        """Get rankings of all users"""
-        users = User.query()
-        for user in users:
-            user_games = Game.query(Game.user == user.key,
-                                    Game.game_over == True)
-            user.update_rating(user_games)
-        return RankingForms(items=[user.to_form() for user in users])
+        """Get rated users, best (lowest) rating first"""
+        # Ratings are kept current as games finish, so this is a single
+        # indexed read
+        query = User.query(User.rating >= 0).order(User.rating)
+        users, next_cursor = fetch_page(
+            query, _page_size(request.number_of_results), request.cursor)
+        return RankingForms(items=[user.to_form() for user in users],
+                            next_cursor=next_cursor)
+
+    @endpoints.method(request_message=USER_STATS_REQUEST,
+                      response_message=UserStatsForm,
+                      path='user/{user_name}/stats',
+                      name='get_user_stats',
+                      http_method='GET')
+    @instrumented('get_user_stats')
+    def get_user_stats(self, request):
+        """Get a user's totals over all finished games"""
+        user = User.query(User.name == request.user_name).get()
+        if not user:
+            raise endpoints.NotFoundException(
+                    'A User with that name does not exist!')
+        # Days already rolled up are read from one DailyScore each, so the
+        # cost grows with days played rather than games
+        totals = DailyScore.totals_for(user.key)
+        return totals.to_stats_form(user.name)
 
     @endpoints.method(request_message=GET_GAME_REQUEST,
                       response_message=HistoryForm,
                       path='game/history/{urlsafe_game_key}',
                       name='get_game_history',
                       http_method='GET')
+    @instrumented('get_game_history')
     def get_game_history(self, request):
         """Get previous guesses of a particular game"""
         game = get_by_urlsafe(request.urlsafe_game_key, Game)
         return game.to_history_form()
 
+    @endpoints.method(request_message=GET_GAME_REQUEST,
+                      response_message=HintForm,
+                      path='game/hint/{urlsafe_game_key}',
+                      name='get_hint',
+                      http_method='GET')
+    @instrumented('get_hint')
+    def get_hint(self, request):
+        """Suggests the letter found in the most dictionary words that fit
+        the game so far"""
+        game = get_by_urlsafe(request.urlsafe_game_key, Game)
+        if not game:
+            raise endpoints.NotFoundException('Game not found!')
+        if game.game_over:
+            raise endpoints.BadRequestException('Game already over!')
+        letter, candidates = hints.get_index().hint(game.guess_field,
+                                                    game.guess_history())
+        return HintForm(urlsafe_key=request.urlsafe_game_key,
+                        letter=letter, candidates=candidates)
+
+    @endpoints.method(response_message=StatsForms,
+                      path='stats',
+                      name='get_stats',
+                      http_method='GET')
+    def get_stats(self, request):
+        """Get latency percentiles and datastore RPCs per call for each
+        endpoint and handler. Admin only"""
+        _check_admin()
+        return StatsForms(items=[StatsForm(**stats) for stats in
+                                 instrumentation.get_stats()])
+
+    @endpoints.method(response_message=StringMessage,
+                      path='admin/export',
+                      name='export_data',
+                      http_method='POST')
+    @instrumented('export_data')
+    def export_data(self, request):
+        """Start exporting all Users, Games and Scores. Admin only"""
+        _check_admin()
+        export_id = bulk.start_export()
+        return StringMessage(message='Export {} started'.format(export_id))
+
+    @endpoints.method(request_message=IMPORT_REQUEST,
+                      response_message=StringMessage,
+                      path='admin/import',
+                      name='import_data',
+                      http_method='POST')
+    @instrumented('import_data')
+    def import_data(self, request):
+        """Start importing the Users, Games and Scores of an export. Admin
+        only"""
+        _check_admin()
+        run = bulk.start_import(request.export_id)
+        return StringMessage(message='Import {} of {} started'.format(
+            run, request.export_id))
+
+    @endpoints.method(response_message=StringMessage,
+                      path='admin/index_active_games',
+                      name='index_active_games',
+                      http_method='POST')
+    @instrumented('index_active_games')
+    def index_active_games(self, request):
+        """Start adding every active game to its User's active games, for
+        games created before Users kept them. Safe to run again. Admin
+        only"""
+        _check_admin()
+        run = 'index-{}'.format(int(time.time()))
+        taskqueue.add(url='/tasks/index_active_games',
+                      params={'run': run, 'batch': 0}, name=run + '-0')
+        return StringMessage(message='Indexing {} started'.format(run))
+
+    @endpoints.method(response_message=StringMessage,
+                      path='admin/rebuild_user_totals',
+                      name='rebuild_user_totals',
+                      http_method='POST')
+    @instrumented('rebuild_user_totals')
+    def rebuild_user_totals(self, request):
+        """Start recomputing every User's totals and rating from their
+        finished games, for users whose games finished before the totals
+        were kept. Safe to run again. Admin only"""
+        _check_admin()
+        run = 'totals-{}'.format(int(time.time()))
+        taskqueue.add(url='/tasks/rebuild_user_totals',
+                      params={'run': run, 'batch': 0}, name=run + '-0')
+        return StringMessage(message='Rebuilding {} started'.format(run))
+
+    @ndb.tasklet
+    def _update_game_async(self, urlsafe_game_key, update,
+                           idempotency_key=None, move_seq=None):
+        """Applies update to the game in a transaction with
+        Game.update_async and resolves the user name for the form. Returns
+        a Future for the game and the messages"""
+        key = get_key(urlsafe_game_key, Game)
+        try:
+            game, results, counters_changed = yield Game.update_async(
+                key, update, idempotency_key=idempotency_key,
+                move_seq=move_seq)
+        except ValueError:
+            raise endpoints.BadRequestException('Guess cannot be '
+                                                'blank!')
+        except StaleMoveError as e:
+            raise endpoints.ConflictException(str(e))
+        except datastore_errors.TransactionFailedError:
+            raise endpoints.ConflictException(
+                'Too many moves at once on this game, please try again')
+        if not game:
+            raise endpoints.NotFoundException('Game not found!')
+        if counters_changed:
+            self._schedule_average_attempts()
+        yield game.get_user_name_async()
+        raise ndb.Return((game, results))
+
     @staticmethod
+    @instrumented('_cache_average_attempts')
     def _cache_average_attempts():
         """Populates memcache with the average moves remaining of Games"""
-        games = Game.query(Game.game_over == False).fetch()
-        if games:
-            count = len(games)
-            total_attempts_remaining = sum([game.attempts_remaining
-                                           for game in games])
-            average = float(total_attempts_remaining)/count
+        counts = counters.get_counts([ACTIVE_GAMES, ATTEMPTS_REMAINING])
+        if counts[ACTIVE_GAMES] > 0:
+            average = (float(counts[ATTEMPTS_REMAINING]) /
+                       counts[ACTIVE_GAMES])
             memcache.set(MEMCACHE_MOVES_REMAINING,
                          'The average moves remaining is {:.2f}'
                          .format(average))
+        else:
+            memcache.delete(MEMCACHE_MOVES_REMAINING)
+
+    @staticmethod
+    def _schedule_average_attempts():
+        """Enqueues a refresh of the cached average moves remaining to run at
+        the end of the current window. Tasks are named after their window so
+        the task queue drops any duplicates."""
+        global _scheduled_window
+        now = time.time()
+        window = int(now // AVERAGE_ATTEMPTS_WINDOW)
+        if window == _scheduled_window:
+            return
+        try:
+            taskqueue.add(url='/tasks/cache_average_attempts',
+                          name='cache-average-attempts-{}'.format(window),
+                          countdown=(window + 1) * AVERAGE_ATTEMPTS_WINDOW -
+                          now)
+        except (taskqueue.TaskAlreadyExistsError,
+                taskqueue.TombstonedTaskError):
+            pass
+        _scheduled_window = window
+
+
+def _check_admin():
+    """Raises unless the request is signed in as an admin"""
+    try:
+        is_admin = oauth.is_current_user_admin(endpoints.EMAIL_SCOPE)
+    except oauth.Error:
+        raise endpoints.UnauthorizedException('Sign in as an admin')
+    if not is_admin:
+        raise endpoints.ForbiddenException('Admin only')
+
+
+def _key_cursor(cursor):
+    """Parses a cursor from get_user_games, the urlsafe key of the last game
+    on the previous page. Returns None for the first page"""
+    if not cursor:
+        return None
+    try:
+        key = get_key(cursor, Game)
+    except (ValueError, endpoints.BadRequestException):
+        raise endpoints.BadRequestException('Invalid cursor')
+    return key
+
+
+def _page_size(requested):
+    """Clamps a requested page size to (0, MAX_PAGE_SIZE]"""
+    if not requested or requested < 1:
+        return DEFAULT_PAGE_SIZE
+    return min(requested, MAX_PAGE_SIZE)
+
 
+# Last window this instance enqueued a refresh for, to skip redundant adds
+_scheduled_window = None
 
 api = endpoints.api_server([HangmanApi])
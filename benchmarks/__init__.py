@@ -0,0 +1 @@
+"""benchmarks - Offline load scenarios for the Hangman API."""
@@ -0,0 +1,36 @@
+"""Runs the benchmark scenarios and prints a summary table.
+
+Usage (from the project root, with Python 2.7):
+    python -m benchmarks [--users N] [--games M] [--active A] [--reads R]
+"""
+
+import argparse
+import sys
+
+from .harness import Recorder
+from .fakes import services
+from . import scenarios
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks')
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--games', type=int, default=500,
+                        help='games played to completion')
+    parser.add_argument('--active', type=int, default=100,
+                        help='games left active for the reminder cron')
+    parser.add_argument('--reads', type=int, default=50,
+                        help='rounds of calls to the read endpoints')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    recorder = Recorder()
+    scenarios.run(recorder, users=args.users, games=args.games,
+                  active=args.active, reads=args.reads, seed=args.seed)
+    print(recorder.report())
+    print('\nreminder emails sent: {}'.format(len(services.outbox)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,68 @@
+"""fakes - In-memory stand-ins for the App Engine SDK, Cloud Endpoints,
+protorpc and webapp2.
+
+Call install() before importing api, models or main. The fakes keep all state
+in process and report every datastore, memcache, taskqueue and mail call
+through a fake apiproxy, so the app can be driven offline and its RPCs
+counted."""
+
+import sys
+import types
+
+from . import endpoints
+from . import ndb
+from . import services
+
+_installed = []
+
+
+def _package(name):
+    module = types.ModuleType(name)
+    module.__path__ = []
+    return module
+
+
+def install():
+    """Registers the fake modules in sys.modules. Safe to call twice."""
+    if _installed:
+        return
+    google = _package('google')
+    appengine = _package('google.appengine')
+    ext = _package('google.appengine.ext')
+    api = _package('google.appengine.api')
+    google.appengine = appengine
+    appengine.ext = ext
+    appengine.api = api
+    ext.ndb = ndb.build_module()
+    api.memcache = services.build_memcache()
+    api.taskqueue = services.build_taskqueue()
+    api.mail = services.build_mail()
+    api.app_identity = services.build_app_identity()
+    api.oauth = services.build_oauth()
+    api.apiproxy_stub_map = services.build_apiproxy_stub_map()
+    api.datastore_errors = services.build_datastore_errors()
+    modules = {
+        'google': google,
+        'google.appengine': appengine,
+        'google.appengine.ext': ext,
+        'google.appengine.api': api,
+        'google.appengine.ext.ndb': ext.ndb,
+        'google.appengine.api.memcache': api.memcache,
+        'google.appengine.api.taskqueue': api.taskqueue,
+        'google.appengine.api.mail': api.mail,
+        'google.appengine.api.app_identity': api.app_identity,
+        'google.appengine.api.oauth': api.oauth,
+        'google.appengine.api.apiproxy_stub_map': api.apiproxy_stub_map,
+        'google.appengine.api.datastore_errors': api.datastore_errors,
+        'endpoints': endpoints.build_endpoints(),
+        'webapp2': endpoints.build_webapp2(),
+    }
+    modules.update(endpoints.build_protorpc())
+    sys.modules.update(modules)
+    _installed.append(True)
+
+
+def reset():
+    """Clears the datastore, memcache, task queue and mail outbox."""
+    ndb.reset()
+    services.reset()
@@ -0,0 +1,313 @@
+"""endpoints.py - In-memory stand-ins for protorpc, Cloud Endpoints and
+webapp2, enough to construct request messages and call API methods and
+handlers directly."""
+
+import functools
+import types
+
+
+def _module(name, doc):
+    module = types.ModuleType(name)
+    module.__doc__ = doc
+    return module
+
+
+# -- protorpc.messages ------------------------------------------------------
+
+class ValidationError(Exception):
+    pass
+
+
+class Field(object):
+    _types = None
+
+    def __init__(self, number, required=False, repeated=False, default=None,
+                 variant=None):
+        self.number = number
+        self.required = required
+        self.repeated = repeated
+        self.default = default
+        self.name = None
+
+    def validate(self, value):
+        if value is None:
+            return
+        values = value if self.repeated else [value]
+        if self.repeated and not isinstance(value, (list, tuple)):
+            raise ValidationError('Field %s is repeated' % self.name)
+        for v in values:
+            if self._types is not None and not isinstance(v, self._types):
+                raise ValidationError('Expected %s for %s, got %r'
+                                      % (self._types, self.name, v))
+
+    def __get__(self, message, cls=None):
+        if message is None:
+            return self
+        if self.name not in message._values:
+            if self.repeated:
+                message._values[self.name] = []
+            else:
+                return self.default
+        return message._values[self.name]
+
+    def __set__(self, message, value):
+        self.validate(value)
+        if self.repeated:
+            value = list(value or [])
+        message._values[self.name] = value
+
+
+class StringField(Field):
+    _types = basestring
+
+
+class IntegerField(Field):
+    _types = (int, long)
+
+
+class FloatField(Field):
+    _types = (int, long, float)
+
+
+class BooleanField(Field):
+    _types = bool
+
+
+class BytesField(Field):
+    _types = str
+
+
+class MessageField(Field):
+    def __init__(self, message_type, number, **kwargs):
+        super(MessageField, self).__init__(number, **kwargs)
+        self.message_type = message_type
+
+    def validate(self, value):
+        self._types = self.message_type
+        super(MessageField, self).validate(value)
+
+
+class _MessageMeta(type):
+    def __init__(cls, name, bases, classdict):
+        super(_MessageMeta, cls).__init__(name, bases, classdict)
+        fields = {}
+        for base in reversed(cls.__mro__[1:]):
+            fields.update(getattr(base, '_fields', {}))
+        for attr, value in classdict.items():
+            if isinstance(value, Field):
+                value.name = attr
+                fields[attr] = value
+        cls._fields = fields
+
+
+class Message(object):
+    __metaclass__ = _MessageMeta
+
+    def __init__(self, **kwargs):
+        self._values = {}
+        for name, value in kwargs.items():
+            if name not in self._fields:
+                raise AttributeError('%s has no field %s'
+                                     % (type(self).__name__, name))
+            setattr(self, name, value)
+
+    @classmethod
+    def all_fields(cls):
+        return sorted(cls._fields.values(), key=lambda f: f.number)
+
+    def check_initialized(self):
+        for field in self.all_fields():
+            value = getattr(self, field.name)
+            if field.required and value is None:
+                raise ValidationError('Message %s is missing required field '
+                                      '%s' % (type(self).__name__,
+                                              field.name))
+            if isinstance(field, MessageField) and value is not None:
+                for v in (value if field.repeated else [value]):
+                    v.check_initialized()
+
+    def __eq__(self, other):
+        return type(self) is type(other) and all(
+            getattr(self, f) == getattr(other, f) for f in self._fields)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '<%s %s>' % (type(self).__name__, ' '.join(
+            '%s=%r' % (f, getattr(self, f)) for f in sorted(self._fields)))
+
+
+class VoidMessage(Message):
+    pass
+
+
+def build_protorpc():
+    package = _module('protorpc', 'Fake protorpc')
+    package.__path__ = []
+    messages = _module('protorpc.messages', 'Fake protorpc.messages')
+    for cls in (Field, StringField, IntegerField, FloatField, BooleanField,
+                BytesField, MessageField, Message, ValidationError):
+        setattr(messages, cls.__name__, cls)
+    message_types = _module('protorpc.message_types',
+                            'Fake protorpc.message_types')
+    message_types.VoidMessage = VoidMessage
+    remote = _module('protorpc.remote', 'Fake protorpc.remote')
+    remote.Service = type('Service', (object,), {})
+    package.messages = messages
+    package.message_types = message_types
+    package.remote = remote
+    return {'protorpc': package, 'protorpc.messages': messages,
+            'protorpc.message_types': message_types,
+            'protorpc.remote': remote}
+
+
+# -- endpoints --------------------------------------------------------------
+
+class ServiceException(Exception):
+    http_status = 400
+
+
+class BadRequestException(ServiceException):
+    http_status = 400
+
+
+class UnauthorizedException(ServiceException):
+    http_status = 401
+
+
+class ForbiddenException(ServiceException):
+    http_status = 403
+
+
+class NotFoundException(ServiceException):
+    http_status = 404
+
+
+class ConflictException(ServiceException):
+    http_status = 409
+
+
+class InternalServerErrorException(ServiceException):
+    http_status = 500
+
+
+class ResourceContainer(object):
+    def __init__(self, _body_message_class=VoidMessage, **fields):
+        attrs = dict(_body_message_class._fields)
+        attrs.update(fields)
+        self.body_message_class = _body_message_class
+        self.combined_message_class = type(
+            'CombinedContainer', (Message,), attrs)
+
+
+def _message_class(message):
+    if isinstance(message, ResourceContainer):
+        return message.combined_message_class
+    return message
+
+
+def method(request_message=VoidMessage, response_message=VoidMessage,
+           name=None, path=None, http_method='POST', **kwargs):
+    request_class = _message_class(request_message)
+    response_class = _message_class(response_message)
+
+    def decorator(func):
+        @functools.wraps(func)
+        def invoke_remote(service, request=None):
+            if request is None:
+                request = request_class()
+            response = func(service, request)
+            if not isinstance(response, response_class):
+                raise ValidationError('%s returned %r, expected %s'
+                                      % (name, response,
+                                         response_class.__name__))
+            response.check_initialized()
+            return response
+        invoke_remote.method_info = {
+            'name': name or func.__name__, 'path': path,
+            'http_method': http_method, 'request_class': request_class,
+            'response_class': response_class}
+        return invoke_remote
+    return decorator
+
+
+def api(name=None, version=None, **kwargs):
+    def decorator(cls):
+        cls.api_info = {'name': name, 'version': version}
+        return cls
+    return decorator
+
+
+current_user = {'user': None}
+
+
+def build_endpoints():
+    module = _module('endpoints', 'Fake Cloud Endpoints')
+    for cls in (ServiceException, BadRequestException, UnauthorizedException,
+                ForbiddenException, NotFoundException, ConflictException,
+                InternalServerErrorException, ResourceContainer):
+        setattr(module, cls.__name__, cls)
+    module.method = method
+    module.api = api
+    module.api_server = lambda services, **kwargs: list(services)
+    module.get_current_user = lambda: current_user['user']
+    module.API_EXPLORER_CLIENT_ID = 'api-explorer'
+    module.EMAIL_SCOPE = 'https://www.googleapis.com/auth/userinfo.email'
+    return module
+
+
+# -- webapp2 ----------------------------------------------------------------
+
+class Request(object):
+    def __init__(self, path='/', params=None, headers=None):
+        self.path = path
+        self.params = dict(params or {})
+        self.headers = dict(headers or {})
+
+    def get(self, name, default_value=''):
+        return self.params.get(name, default_value)
+
+
+class Response(object):
+    def __init__(self):
+        self.status_int = 200
+        self.body = []
+
+    def set_status(self, code, message=None):
+        self.status_int = code
+
+    def write(self, text):
+        self.body.append(text)
+
+    @property
+    def out(self):
+        return self
+
+
+class RequestHandler(object):
+    def __init__(self, request=None, response=None):
+        self.request = request or Request()
+        self.response = response or Response()
+
+    def abort(self, code, *args, **kwargs):
+        raise Exception('HTTP %d' % code)
+
+
+class WSGIApplication(object):
+    def __init__(self, routes=None, debug=False, config=None):
+        self.routes = list(routes or [])
+        self.debug = debug
+
+    def handler_for(self, path):
+        for route, handler in self.routes:
+            if route == path:
+                return handler
+        raise KeyError('No route for %s' % path)
+
+
+def build_webapp2():
+    module = _module('webapp2', 'Fake webapp2')
+    for cls in (Request, Response, RequestHandler, WSGIApplication):
+        setattr(module, cls.__name__, cls)
+    return module
@@ -0,0 +1,1088 @@
+"""ndb.py - In-memory stand-in for google.appengine.ext.ndb.
+
+Implements the subset of the ndb API the app uses: models and properties,
+keys, queries with cursors, batch and async operations, tasklets and
+optimistic transactions. Every datastore RPC is reported through the fake
+apiproxy hooks so callers can count them. The memcache-backed global cache of
+real ndb is not emulated; the per-request context cache is."""
+
+import base64
+import copy
+import cPickle as pickle
+import datetime
+import functools
+import itertools
+import json
+import sys
+import threading
+import types
+
+from . import services
+from .services import (BadArgumentError, BadQueryError, BadRequestError,
+                       BadValueError, Rollback, TransactionFailedError)
+
+_lock = threading.RLock()
+_store = {}
+_versions = {}
+_ids = itertools.count(1)
+_local = threading.local()
+_kind_map = {}
+
+
+def _rpc(call):
+    services.record_rpc('datastore_v3', call)
+
+
+def reset():
+    """Drops all stored entities and the current context cache."""
+    with _lock:
+        _store.clear()
+        _versions.clear()
+    get_context().clear_cache()
+
+
+# -- futures and tasklets ---------------------------------------------------
+
+class Return(StopIteration):
+    pass
+
+
+class Future(object):
+    """An already-resolved future; the fake runs every RPC eagerly."""
+    def __init__(self, result=None, exc_info=None):
+        self._result = result
+        self._exc_info = exc_info
+
+    def done(self):
+        return True
+
+    def wait(self):
+        pass
+
+    def check_success(self):
+        self.get_result()
+
+    def get_exception(self):
+        return self._exc_info[1] if self._exc_info else None
+
+    def get_result(self):
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    @staticmethod
+    def wait_all(futures):
+        pass
+
+
+def _future(func, *args, **kwargs):
+    try:
+        return Future(func(*args, **kwargs))
+    except Exception:
+        return Future(exc_info=sys.exc_info())
+
+
+def _resolve(value):
+    if isinstance(value, Future):
+        return value.get_result()
+    if isinstance(value, (list, tuple)):
+        return [_resolve(v) for v in value]
+    return value
+
+
+def _drive(gen):
+    value, exc_info = None, None
+    while True:
+        try:
+            if exc_info:
+                yielded = gen.throw(*exc_info)
+            else:
+                yielded = gen.send(value)
+        except Return as ret:
+            return ret.args[0] if ret.args else None
+        except StopIteration:
+            return None
+        value, exc_info = None, None
+        try:
+            value = _resolve(yielded)
+        except Exception:
+            exc_info = sys.exc_info()
+
+
+def tasklet(func):
+    @functools.wraps(func)
+    def tasklet_wrapper(*args, **kwargs):
+        try:
+            result = func(*args, **kwargs)
+            if isinstance(result, types.GeneratorType):
+                result = _drive(result)
+            return Future(result)
+        except Return as ret:
+            return Future(ret.args[0] if ret.args else None)
+        except Exception:
+            return Future(exc_info=sys.exc_info())
+    return tasklet_wrapper
+
+
+def synctasklet(func):
+    taskletfunc = tasklet(func)
+
+    @functools.wraps(func)
+    def synctasklet_wrapper(*args, **kwargs):
+        return taskletfunc(*args, **kwargs).get_result()
+    return synctasklet_wrapper
+
+
+def toplevel(func):
+    synctaskletfunc = synctasklet(func)
+
+    @functools.wraps(func)
+    def toplevel_wrapper(*args, **kwargs):
+        return synctaskletfunc(*args, **kwargs)
+    return toplevel_wrapper
+
+
+def sleep(seconds):
+    return Future(None)
+
+
+# -- context ----------------------------------------------------------------
+
+class Context(object):
+    def __init__(self):
+        self.cache = {}
+
+    def clear_cache(self):
+        self.cache.clear()
+
+    def set_cache_policy(self, policy):
+        pass
+
+    def set_memcache_policy(self, policy):
+        pass
+
+
+def get_context():
+    if not hasattr(_local, 'context'):
+        _local.context = Context()
+    return _local.context
+
+
+def _txn():
+    return getattr(_local, 'txn', None)
+
+
+def in_transaction():
+    return _txn() is not None
+
+
+services.taskqueue.current_transaction = _txn
+
+
+# -- keys -------------------------------------------------------------------
+
+def _encode(pairs):
+    return base64.urlsafe_b64encode(json.dumps(pairs)).rstrip('=')
+
+
+def _decode(urlsafe):
+    try:
+        raw = base64.urlsafe_b64decode(
+            str(urlsafe) + '=' * (-len(urlsafe) % 4))
+        pairs = json.loads(raw)
+    except (ValueError, UnicodeEncodeError):
+        raise TypeError('Invalid urlsafe key %r' % urlsafe)
+    if not isinstance(pairs, list) or not pairs:
+        raise TypeError('Invalid urlsafe key %r' % urlsafe)
+    return [(str(kind), id) for kind, id in pairs]
+
+
+class Key(object):
+    def __init__(self, *args, **kwargs):
+        urlsafe = kwargs.pop('urlsafe', None)
+        parent = kwargs.pop('parent', None)
+        pairs = kwargs.pop('pairs', None)
+        flat = kwargs.pop('flat', None)
+        if urlsafe is not None:
+            pairs = _decode(urlsafe)
+        elif pairs is None:
+            if flat is None:
+                flat = args[0] if len(args) == 1 else args
+            if len(flat) % 2:
+                raise BadArgumentError('Key needs kind/id pairs')
+            pairs = []
+            for kind, id in zip(flat[::2], flat[1::2]):
+                if isinstance(kind, type):
+                    kind = kind._get_kind()
+                pairs.append((kind, id))
+        if parent is not None:
+            pairs = list(parent.pairs()) + list(pairs)
+        self._pairs = tuple((kind, id) for kind, id in pairs)
+
+    def pairs(self):
+        return self._pairs
+
+    def flat(self):
+        return tuple(itertools.chain.from_iterable(self._pairs))
+
+    def kind(self):
+        return self._pairs[-1][0]
+
+    def id(self):
+        return self._pairs[-1][1]
+
+    def string_id(self):
+        id = self.id()
+        return id if isinstance(id, basestring) else None
+
+    def integer_id(self):
+        id = self.id()
+        return id if isinstance(id, (int, long)) else None
+
+    def parent(self):
+        if len(self._pairs) < 2:
+            return None
+        return Key(pairs=self._pairs[:-1])
+
+    def root(self):
+        return Key(pairs=self._pairs[:1])
+
+    def urlsafe(self):
+        return _encode(self._pairs)
+
+    def get(self, **options):
+        return get_multi([self])[0]
+
+    def get_async(self, **options):
+        return _future(self.get)
+
+    def delete(self, **options):
+        delete_multi([self])
+
+    def delete_async(self, **options):
+        return _future(self.delete)
+
+    def __eq__(self, other):
+        return isinstance(other, Key) and self._pairs == other._pairs
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __lt__(self, other):
+        return self._pairs < other._pairs
+
+    def __hash__(self):
+        return hash(self._pairs)
+
+    def __repr__(self):
+        return 'Key(%s)' % ', '.join(repr(p) for p in self.flat())
+
+    def __getstate__(self):
+        return {'pairs': self._pairs}
+
+    def __setstate__(self, state):
+        self._pairs = state['pairs']
+
+
+class Cursor(object):
+    def __init__(self, urlsafe=None, offset=0):
+        if urlsafe is not None:
+            try:
+                offset = int(base64.urlsafe_b64decode(
+                    str(urlsafe) + '=' * (-len(urlsafe) % 4))[2:])
+            except (TypeError, ValueError, UnicodeEncodeError):
+                raise BadValueError('Invalid cursor %r' % urlsafe)
+        self.offset = offset
+
+    def urlsafe(self):
+        return base64.urlsafe_b64encode('o:%d' % self.offset).rstrip('=')
+
+    def __eq__(self, other):
+        return isinstance(other, Cursor) and self.offset == other.offset
+
+
+# -- properties -------------------------------------------------------------
+
+class FilterNode(object):
+    def __init__(self, name, op, value):
+        self.name = name
+        self.op = op
+        self.value = value
+
+    def match(self, values):
+        if self.name not in values:
+            return False
+        stored = values[self.name]
+        candidates = stored if isinstance(stored, list) else [stored]
+        for v in candidates:
+            if self.op == '=' and v == self.value:
+                return True
+            if self.op == '!=' and v != self.value:
+                return True
+            if v is None or self.value is None:
+                continue
+            if ((self.op == '<' and v < self.value) or
+                    (self.op == '<=' and v <= self.value) or
+                    (self.op == '>' and v > self.value) or
+                    (self.op == '>=' and v >= self.value)):
+                return True
+        return False
+
+
+class ConjunctionNode(object):
+    def __init__(self, *nodes):
+        self.nodes = nodes
+
+    def match(self, values):
+        return all(node.match(values) for node in self.nodes)
+
+
+class DisjunctionNode(object):
+    def __init__(self, *nodes):
+        self.nodes = nodes
+
+    def match(self, values):
+        return any(node.match(values) for node in self.nodes)
+
+
+def _subqueries(node):
+    """The number of datastore queries ndb runs for a filter, as it expands
+    IN and OR filters into one query per disjunct"""
+    if isinstance(node, DisjunctionNode):
+        return sum(_subqueries(child) for child in node.nodes)
+    if isinstance(node, ConjunctionNode):
+        runs = 1
+        for child in node.nodes:
+            runs *= _subqueries(child)
+        return runs
+    return 1
+
+
+AND = ConjunctionNode
+OR = DisjunctionNode
+
+
+class PropertyOrder(object):
+    def __init__(self, name, descending=False):
+        self.name = name
+        self.descending = descending
+
+
+class Property(object):
+    _types = None
+
+    def __init__(self, name=None, indexed=True, repeated=False,
+                 required=False, default=None, choices=None, validator=None,
+                 verbose_name=None):
+        self._name = name
+        self._indexed = indexed
+        self._repeated = repeated
+        self._required = required
+        self._default = default
+        self._choices = choices
+        self._validator = validator
+
+    def _fix_up(self, cls, code_name):
+        self._code_name = code_name
+        if self._name is None:
+            self._name = code_name
+
+    def _check_type(self, value):
+        if self._types is not None and not isinstance(value, self._types):
+            raise BadValueError('Expected %s for %s, got %r'
+                                % (self._types, self._name, value))
+
+    def _validate(self, value):
+        if value is None:
+            return value
+        self._check_type(value)
+        if self._choices is not None and value not in self._choices:
+            raise BadValueError('%r not in choices' % (value,))
+        if self._validator is not None:
+            result = self._validator(self, value)
+            if result is not None:
+                value = result
+        return value
+
+    def _get_value(self, entity):
+        if self._name in entity._values:
+            return entity._values[self._name]
+        if self._repeated:
+            entity._values[self._name] = []
+            return entity._values[self._name]
+        return self._default
+
+    def __get__(self, entity, cls=None):
+        if entity is None:
+            return self
+        return self._get_value(entity)
+
+    def __set__(self, entity, value):
+        if self._repeated:
+            if value is None:
+                value = []
+            if not isinstance(value, (list, tuple)):
+                raise BadValueError('Expected list for %s' % self._name)
+            value = [self._validate(v) for v in value]
+        else:
+            value = self._validate(value)
+        entity._values[self._name] = value
+
+    def _to_storage(self, value):
+        return copy.deepcopy(value)
+
+    def _from_storage(self, value):
+        return copy.deepcopy(value)
+
+    def _comparison(self, op, value):
+        if not self._indexed:
+            raise BadQueryError('Cannot query for unindexed property %s'
+                                % self._name)
+        if value is not None:
+            value = self._validate(value)
+        return FilterNode(self._name, op, value)
+
+    def __eq__(self, value):
+        return self._comparison('=', value)
+
+    def __ne__(self, value):
+        return self._comparison('!=', value)
+
+    def __lt__(self, value):
+        return self._comparison('<', value)
+
+    def __le__(self, value):
+        return self._comparison('<=', value)
+
+    def __gt__(self, value):
+        return self._comparison('>', value)
+
+    def __ge__(self, value):
+        return self._comparison('>=', value)
+
+    def __neg__(self):
+        return PropertyOrder(self._name, descending=True)
+
+    def __pos__(self):
+        return PropertyOrder(self._name)
+
+    def __hash__(self):
+        return id(self)
+
+    def IN(self, values):
+        return DisjunctionNode(*[self._comparison('=', v) for v in values])
+
+
+class StringProperty(Property):
+    _types = basestring
+
+
+class TextProperty(Property):
+    _types = basestring
+
+    def __init__(self, *args, **kwargs):
+        kwargs['indexed'] = False
+        super(TextProperty, self).__init__(*args, **kwargs)
+
+
+class IntegerProperty(Property):
+    _types = (int, long)
+
+
+class FloatProperty(Property):
+    _types = (int, long, float)
+
+
+class BooleanProperty(Property):
+    _types = bool
+
+
+class DateProperty(Property):
+    _types = datetime.date
+
+
+class DateTimeProperty(Property):
+    _types = datetime.datetime
+
+    def __init__(self, *args, **kwargs):
+        self._auto_now = kwargs.pop('auto_now', False)
+        self._auto_now_add = kwargs.pop('auto_now_add', False)
+        super(DateTimeProperty, self).__init__(*args, **kwargs)
+
+    def _prepare_for_put(self, entity):
+        if self._auto_now or (self._auto_now_add and
+                              self._name not in entity._values):
+            entity._values[self._name] = datetime.datetime.now()
+
+
+class KeyProperty(Property):
+    _types = Key
+
+    def __init__(self, *args, **kwargs):
+        self._kind = kwargs.pop('kind', None)
+        if isinstance(self._kind, type):
+            self._kind = self._kind._get_kind()
+        super(KeyProperty, self).__init__(*args, **kwargs)
+
+    def _validate(self, value):
+        value = super(KeyProperty, self)._validate(value)
+        if value is not None and self._kind and value.kind() != self._kind:
+            raise BadValueError('Expected key of kind %s, got %r'
+                                % (self._kind, value))
+        return value
+
+
+class BlobProperty(Property):
+    _types = str
+
+    def __init__(self, *args, **kwargs):
+        kwargs.pop('compressed', None)
+        kwargs.setdefault('indexed', False)
+        super(BlobProperty, self).__init__(*args, **kwargs)
+
+
+class JsonProperty(BlobProperty):
+    _types = None
+
+    def _to_storage(self, value):
+        return json.dumps(value)
+
+    def _from_storage(self, value):
+        return json.loads(value)
+
+
+class PickleProperty(BlobProperty):
+    _types = None
+
+    def _to_storage(self, value):
+        return pickle.dumps(value, 2)
+
+    def _from_storage(self, value):
+        return pickle.loads(value)
+
+
+class ComputedPropertyError(BadValueError):
+    pass
+
+
+class ComputedProperty(Property):
+    def __init__(self, func, name=None, indexed=True, repeated=False):
+        super(ComputedProperty, self).__init__(name=name, indexed=indexed,
+                                               repeated=repeated)
+        self._func = func
+
+    def _get_value(self, entity):
+        if entity._projection and self._name in entity._values:
+            return entity._values[self._name]
+        return self._func(entity)
+
+    def __set__(self, entity, value):
+        raise ComputedPropertyError('Cannot assign to a ComputedProperty')
+
+    def _validate(self, value):
+        return value
+
+
+# -- models -----------------------------------------------------------------
+
+class MetaModel(type):
+    def __init__(cls, name, bases, classdict):
+        super(MetaModel, cls).__init__(name, bases, classdict)
+        properties = {}
+        for base in reversed(cls.__mro__[1:]):
+            properties.update(getattr(base, '_properties', {}))
+        for attr, value in classdict.items():
+            if isinstance(value, Property):
+                value._fix_up(cls, attr)
+                properties[value._name] = value
+        cls._properties = properties
+        if name != 'Model':
+            _kind_map[cls._get_kind()] = cls
+
+
+class Model(object):
+    __metaclass__ = MetaModel
+
+    _use_cache = True
+    _use_memcache = True
+
+    def __init__(self, key=None, id=None, parent=None, **kwargs):
+        self._values = {}
+        self._projection = ()
+        if key is None and (id is not None or parent is not None):
+            key = Key(self._get_kind(), id, parent=parent)
+        self.key = key
+        self.populate(**kwargs)
+
+    @classmethod
+    def _get_kind(cls):
+        return cls.__name__
+
+    def populate(self, **kwargs):
+        for name, value in kwargs.items():
+            if name not in self._properties:
+                raise TypeError('Unknown property %s' % name)
+            setattr(self, name, value)
+
+    def to_dict(self, include=None, exclude=None):
+        result = {}
+        for name, prop in self._properties.items():
+            if include is not None and name not in include:
+                continue
+            if exclude is not None and name in exclude:
+                continue
+            result[name] = prop._get_value(self)
+        return result
+
+    def _pre_put_hook(self):
+        pass
+
+    def _post_put_hook(self, future):
+        pass
+
+    @classmethod
+    def _pre_get_hook(cls, key):
+        pass
+
+    @classmethod
+    def _post_get_hook(cls, key, future):
+        pass
+
+    def _to_stored(self):
+        stored = {}
+        for name, prop in self._properties.items():
+            if hasattr(prop, '_prepare_for_put'):
+                prop._prepare_for_put(self)
+            value = prop._get_value(self)
+            if prop._required and value is None:
+                raise BadValueError('Entity has uninitialized properties: '
+                                    '%s' % name)
+            stored[name] = prop._to_storage(value)
+        return stored
+
+    @classmethod
+    def _from_stored(cls, key, stored):
+        entity = cls()
+        entity.key = key
+        for name, value in stored.items():
+            prop = cls._properties.get(name)
+            if prop is None:
+                entity._values[name] = value
+            elif not isinstance(prop, ComputedProperty):
+                entity._values[name] = prop._from_storage(value)
+        return entity
+
+    def put(self, **options):
+        return put_multi([self])[0]
+
+    def put_async(self, **options):
+        return _future(self.put)
+
+    @classmethod
+    def get_by_id(cls, id, parent=None, **options):
+        return Key(cls, id, parent=parent).get()
+
+    @classmethod
+    def get_by_id_async(cls, id, parent=None, **options):
+        return Key(cls, id, parent=parent).get_async()
+
+    @classmethod
+    def get_or_insert(cls, name, parent=None, **kwargs):
+        def txn():
+            key = Key(cls, name, parent=parent)
+            entity = key.get()
+            if entity is None:
+                entity = cls(key=key, **kwargs)
+                entity.put()
+            return entity
+        if in_transaction():
+            return txn()
+        return transaction(txn)
+
+    @classmethod
+    def allocate_ids(cls, size=None, parent=None, max=None, **options):
+        _rpc('AllocateIds')
+        with _lock:
+            first = next(_ids)
+            for _ in xrange((size or 1) - 1):
+                last = next(_ids)
+            return first, first + (size or 1) - 1
+
+    @classmethod
+    def query(cls, *filters, **kwargs):
+        return Query(kind=cls._get_kind(), filters=filters, **kwargs)
+
+    def __eq__(self, other):
+        return (type(self) is type(other) and self.key == other.key and
+                self._to_stored() == other._to_stored())
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '%s(key=%r, %s)' % (
+            self.__class__.__name__, self.key,
+            ', '.join('%s=%r' % (k, v) for k, v in sorted(
+                self._values.items())))
+
+    def __getstate__(self):
+        return {'key': self.key, 'values': self._to_stored()}
+
+    def __setstate__(self, state):
+        self.__dict__.update(
+            self._from_stored(state['key'], state['values']).__dict__)
+
+
+# -- datastore operations ---------------------------------------------------
+
+class _Transaction(object):
+    def __init__(self, xg):
+        self.xg = xg
+        self.read_versions = {}
+        self.writes = {}
+        self.deletes = set()
+        self.cache = {}
+        # Transactional tasks, enqueued if the transaction commits
+        self.tasks = []
+
+    def touch(self, key):
+        root = key.pairs()[:1]
+        if root not in self.read_versions:
+            if self.read_versions and not self.xg:
+                raise BadRequestError('cross-groups transaction need to be '
+                                      'explicitly specified (xg=True)')
+            if len(self.read_versions) >= 25:
+                raise BadRequestError('operating on too many entity groups '
+                                      'in a single transaction.')
+            with _lock:
+                self.read_versions[root] = _versions.get(root, 0)
+
+
+def _complete(key, entity):
+    if key is None:
+        key = Key(entity._get_kind(), None)
+    if key.id() is None:
+        with _lock:
+            key = Key(key.kind(), next(_ids), parent=key.parent())
+    entity.key = key
+    return key
+
+
+def _commit_writes(writes, deletes):
+    with _lock:
+        for pairs in deletes:
+            _store.pop(pairs, None)
+            _versions[pairs[:1]] = _versions.get(pairs[:1], 0) + 1
+        for pairs, stored in writes.items():
+            _store[pairs] = stored
+            _versions[pairs[:1]] = _versions.get(pairs[:1], 0) + 1
+
+
+def get_multi(keys, **options):
+    txn = _txn()
+    cache = txn.cache if txn else get_context().cache
+    results = []
+    missing = []
+    for key in keys:
+        cls = _kind_map.get(key.kind())
+        if cls is not None:
+            cls._pre_get_hook(key)
+        if txn:
+            txn.touch(key)
+        use_cache = cls is None or cls._use_cache
+        if use_cache and key in cache:
+            results.append(cache[key])
+        else:
+            results.append(None)
+            missing.append(len(results) - 1)
+    if missing:
+        _rpc('Get')
+        with _lock:
+            found = [(i, _store.get(keys[i].pairs())) for i in missing]
+        for i, stored in found:
+            key = keys[i]
+            if txn and key.pairs() in txn.writes:
+                stored = txn.writes[key.pairs()]
+            if txn and key.pairs() in txn.deletes:
+                stored = None
+            if stored is not None:
+                entity = _kind_map[key.kind()]._from_stored(key, stored)
+                results[i] = entity
+                cache[key] = entity
+    for key, entity in zip(keys, results):
+        cls = _kind_map.get(key.kind())
+        if cls is not None:
+            cls._post_get_hook(key, Future(entity))
+    return results
+
+
+def put_multi(entities, **options):
+    if not entities:
+        return []
+    txn = _txn()
+    cache = txn.cache if txn else get_context().cache
+    keys = []
+    writes = {}
+    for entity in entities:
+        entity._pre_put_hook()
+        key = _complete(entity.key, entity)
+        if txn:
+            txn.touch(key)
+        writes[key.pairs()] = entity._to_stored()
+        keys.append(key)
+    try:
+        _rpc('Put')
+    except Exception:
+        # Like ndb, post-put hooks also run for a put that failed
+        exc_info = sys.exc_info()
+        for entity in entities:
+            entity._post_put_hook(Future(exc_info=exc_info))
+        raise exc_info[0], exc_info[1], exc_info[2]
+    if txn:
+        txn.writes.update(writes)
+        txn.deletes.difference_update(writes)
+    else:
+        _commit_writes(writes, ())
+    for entity, key in zip(entities, keys):
+        if entity._use_cache:
+            cache[key] = entity
+        entity._post_put_hook(Future(key))
+    return keys
+
+
+def delete_multi(keys, **options):
+    if not keys:
+        return []
+    txn = _txn()
+    cache = txn.cache if txn else get_context().cache
+    _rpc('Delete')
+    for key in keys:
+        cache.pop(key, None)
+    if txn:
+        for key in keys:
+            txn.touch(key)
+            txn.writes.pop(key.pairs(), None)
+            txn.deletes.add(key.pairs())
+    else:
+        _commit_writes({}, [key.pairs() for key in keys])
+    return [None] * len(keys)
+
+
+def get_multi_async(keys, **options):
+    try:
+        return [Future(entity) for entity in get_multi(keys, **options)]
+    except Exception:
+        return [Future(exc_info=sys.exc_info()) for _ in keys]
+
+
+def put_multi_async(entities, **options):
+    try:
+        return [Future(key) for key in put_multi(entities, **options)]
+    except Exception:
+        return [Future(exc_info=sys.exc_info()) for _ in entities]
+
+
+def delete_multi_async(keys, **options):
+    try:
+        return [Future(None) for _ in delete_multi(keys, **options)]
+    except Exception:
+        return [Future(exc_info=sys.exc_info()) for _ in keys]
+
+
+def transaction(callback, retries=3, xg=False, **options):
+    if in_transaction():
+        raise BadRequestError('Nested transactions are not supported.')
+    for _ in xrange(retries + 1):
+        txn = _Transaction(xg)
+        _rpc('BeginTransaction')
+        _local.txn = txn
+        try:
+            try:
+                result = callback()
+            except Rollback:
+                return None
+        finally:
+            _local.txn = None
+        _rpc('Commit')
+        with _lock:
+            conflict = any(_versions.get(root, 0) != version
+                           for root, version in txn.read_versions.items())
+            if not conflict:
+                _commit_writes(txn.writes, txn.deletes)
+        if not conflict:
+            context_cache = get_context().cache
+            for key, entity in txn.cache.items():
+                if key.pairs() in txn.writes:
+                    context_cache[key] = entity
+            for pairs in txn.deletes:
+                context_cache.pop(Key(pairs=pairs), None)
+            for task in txn.tasks:
+                services.taskqueue._enqueue(task)
+            return result
+    raise TransactionFailedError('The transaction could not be committed. '
+                                 'Please try again.')
+
+
+def transaction_async(callback, **options):
+    return _future(transaction, callback, **options)
+
+
+def transactional(func=None, **options):
+    def decorator(func):
+        @functools.wraps(func)
+        def transactional_wrapper(*args, **kwargs):
+            if in_transaction():
+                return func(*args, **kwargs)
+            return transaction(lambda: func(*args, **kwargs), **options)
+        return transactional_wrapper
+    if func is not None:
+        return decorator(func)
+    return decorator
+
+
+def transactional_tasklet(func=None, **options):
+    def decorator(func):
+        taskletfunc = tasklet(func)
+
+        @functools.wraps(func)
+        def transactional_tasklet_wrapper(*args, **kwargs):
+            if in_transaction():
+                return taskletfunc(*args, **kwargs)
+            return transaction_async(
+                lambda: taskletfunc(*args, **kwargs).get_result(), **options)
+        return transactional_tasklet_wrapper
+    if func is not None:
+        return decorator(func)
+    return decorator
+
+
+# -- queries ----------------------------------------------------------------
+
+class Query(object):
+    def __init__(self, kind=None, filters=(), orders=(), ancestor=None,
+                 projection=None, distinct=False, default_options=None):
+        self.kind = kind
+        self.filters = tuple(f for f in filters if f is not None)
+        self.orders = tuple(orders)
+        self.ancestor = ancestor
+        self.projection = tuple(
+            p._name if isinstance(p, Property) else p
+            for p in (projection or ()))
+        self.distinct = distinct
+
+    def _clone(self, **changes):
+        args = dict(kind=self.kind, filters=self.filters, orders=self.orders,
+                    ancestor=self.ancestor, projection=self.projection,
+                    distinct=self.distinct)
+        args.update(changes)
+        return Query(**args)
+
+    def filter(self, *filters):
+        return self._clone(filters=self.filters + filters)
+
+    def order(self, *orders):
+        orders = tuple(o if isinstance(o, PropertyOrder)
+                       else PropertyOrder(o._name) for o in orders)
+        return self._clone(orders=self.orders + orders)
+
+    def _run(self, keys_only=False, projection=None):
+        txn = _txn()
+        if txn is not None:
+            if self.ancestor is None:
+                raise BadRequestError('Only ancestor queries are allowed '
+                                      'inside transactions.')
+            txn.touch(self.ancestor)
+        projection = tuple(
+            p._name if isinstance(p, Property) else p
+            for p in (projection or ())) or self.projection
+        for _ in range(_subqueries(ConjunctionNode(*self.filters))):
+            _rpc('RunQuery')
+        with _lock:
+            rows = [(Key(pairs=pairs), stored)
+                    for pairs, stored in _store.items()
+                    if pairs[-1][0] == self.kind]
+        if self.ancestor is not None:
+            prefix = self.ancestor.pairs()
+            rows = [(k, s) for k, s in rows
+                    if k.pairs()[:len(prefix)] == prefix]
+        for node in self.filters:
+            rows = [(k, s) for k, s in rows if node.match(s)]
+        for name in projection:
+            rows = [(k, s) for k, s in rows if name in s]
+        rows.sort(key=lambda row: row[0])
+        for order in reversed(self.orders):
+            rows = [(k, s) for k, s in rows if order.name in s]
+            rows.sort(key=lambda row: row[1][order.name],
+                      reverse=order.descending)
+        if keys_only:
+            return [k for k, _ in rows]
+        if projection:
+            results, seen = [], set()
+            cls = _kind_map[self.kind]
+            for key, stored in rows:
+                values = tuple(stored[name] for name in projection)
+                if self.distinct:
+                    if values in seen:
+                        continue
+                    seen.add(values)
+                entity = cls._from_stored(
+                    key, dict(zip(projection, values)))
+                entity._projection = projection
+                for name, value in zip(projection, values):
+                    entity._values[name] = value
+                results.append(entity)
+            return results
+        cls = _kind_map[self.kind]
+        return [cls._from_stored(k, s) for k, s in rows]
+
+    def fetch(self, limit=None, offset=0, keys_only=False, projection=None,
+              **options):
+        results = self._run(keys_only, projection)[offset:]
+        return results if limit is None else results[:limit]
+
+    def fetch_async(self, limit=None, **options):
+        return _future(self.fetch, limit, **options)
+
+    def fetch_page(self, page_size, start_cursor=None, keys_only=False,
+                   projection=None, **options):
+        start = start_cursor.offset if start_cursor else 0
+        rows = self._run(keys_only, projection)
+        page = rows[start:start + page_size]
+        end = start + len(page)
+        cursor = Cursor(offset=end) if page else None
+        return page, cursor, end < len(rows)
+
+    def fetch_page_async(self, page_size, **options):
+        return _future(self.fetch_page, page_size, **options)
+
+    def get(self, **options):
+        results = self.fetch(1, **options)
+        return results[0] if results else None
+
+    def count(self, limit=None, **options):
+        return len(self.fetch(limit, keys_only=True))
+
+    def iter(self, keys_only=False, projection=None, **options):
+        return iter(self._run(keys_only, projection))
+
+    def __iter__(self):
+        return self.iter()
+
+
+def build_module():
+    module = types.ModuleType('google.appengine.ext.ndb')
+    module.__doc__ = __doc__
+    for name in ('Model', 'Key', 'Cursor', 'Future', 'Return', 'Query',
+                 'Property', 'StringProperty', 'TextProperty',
+                 'IntegerProperty', 'FloatProperty', 'BooleanProperty',
+                 'DateProperty', 'DateTimeProperty', 'KeyProperty',
+                 'BlobProperty', 'JsonProperty', 'PickleProperty',
+                 'ComputedProperty', 'ComputedPropertyError', 'AND', 'OR',
+                 'get_multi', 'put_multi', 'delete_multi', 'get_multi_async',
+                 'put_multi_async', 'delete_multi_async', 'transaction',
+                 'transaction_async', 'transactional',
+                 'transactional_tasklet', 'in_transaction', 'tasklet',
+                 'synctasklet', 'toplevel', 'sleep', 'get_context',
+                 'Context'):
+        setattr(module, name, globals()[name])
+    return module
@@ -0,0 +1,419 @@
+"""services.py - In-memory stand-ins for the App Engine service APIs used by
+the app: memcache, taskqueue, mail, app_identity, oauth, datastore_errors and
+the apiproxy hook registry."""
+
+import cPickle as pickle
+import time
+import types
+
+
+def _module(name, doc):
+    module = types.ModuleType(name)
+    module.__doc__ = doc
+    return module
+
+
+# -- apiproxy_stub_map ------------------------------------------------------
+
+class _HookList(object):
+    """Mirrors apiproxy_stub_map.APIProxyStubMap hook lists."""
+    def __init__(self):
+        self._hooks = []
+
+    def Append(self, key, function, service=None):
+        if any(k == key for k, _, _ in self._hooks):
+            return False
+        self._hooks.append((key, function, service))
+        return True
+
+    def Push(self, key, function, service=None):
+        if any(k == key for k, _, _ in self._hooks):
+            return False
+        self._hooks.insert(0, (key, function, service))
+        return True
+
+    def Clear(self):
+        del self._hooks[:]
+
+    def Call(self, service, call, request, response):
+        for _, function, hook_service in self._hooks:
+            if hook_service is None or hook_service == service:
+                function(service, call, request, response)
+
+
+class _APIProxy(object):
+    def __init__(self):
+        self._pre = _HookList()
+        self._post = _HookList()
+
+    def GetPreCallHooks(self):
+        return self._pre
+
+    def GetPostCallHooks(self):
+        return self._post
+
+
+apiproxy = _APIProxy()
+rpc_counts = {}
+
+
+def record_rpc(service, call, request=None, response=None):
+    """Counts an RPC and runs the registered hooks, as the real apiproxy
+    does around every service call."""
+    rpc_counts[(service, call)] = rpc_counts.get((service, call), 0) + 1
+    apiproxy.GetPreCallHooks().Call(service, call, request, response)
+    apiproxy.GetPostCallHooks().Call(service, call, request, response)
+
+
+def build_apiproxy_stub_map():
+    module = _module('google.appengine.api.apiproxy_stub_map',
+                     'Fake apiproxy_stub_map')
+    module.apiproxy = apiproxy
+    return module
+
+
+# -- datastore_errors -------------------------------------------------------
+
+class DatastoreError(Exception):
+    pass
+
+
+class BadValueError(DatastoreError):
+    pass
+
+
+class BadArgumentError(DatastoreError):
+    pass
+
+
+class BadRequestError(DatastoreError):
+    pass
+
+
+class BadQueryError(DatastoreError):
+    pass
+
+
+class Rollback(DatastoreError):
+    pass
+
+
+class TransactionFailedError(DatastoreError):
+    pass
+
+
+def build_datastore_errors():
+    module = _module('google.appengine.api.datastore_errors',
+                     'Fake datastore_errors')
+    module.Error = DatastoreError
+    for cls in (BadValueError, BadArgumentError, BadRequestError,
+                BadQueryError, Rollback, TransactionFailedError):
+        setattr(module, cls.__name__, cls)
+    return module
+
+
+# -- memcache ---------------------------------------------------------------
+
+class _Memcache(object):
+    """Single process memcache with expiry; values are pickled on the way in
+    so callers get copies, as with the real service."""
+    def __init__(self):
+        self._data = {}
+        # Keys deleted with seconds, refused by add() until the given time
+        self._locks = {}
+
+    def reset(self):
+        self._data.clear()
+        self._locks.clear()
+
+    def _now(self):
+        return time.time()
+
+    def _live(self, key):
+        item = self._data.get(key)
+        if item is None:
+            return None
+        value, expires = item
+        if expires and expires <= self._now():
+            del self._data[key]
+            return None
+        return item
+
+    def _expiry(self, expires):
+        if not expires:
+            return 0
+        return self._now() + expires
+
+    def get(self, key, namespace=None):
+        record_rpc('memcache', 'Get')
+        item = self._live(key)
+        return pickle.loads(item[0]) if item else None
+
+    def get_multi(self, keys, key_prefix='', namespace=None):
+        record_rpc('memcache', 'Get')
+        result = {}
+        for key in keys:
+            item = self._live(key_prefix + key)
+            if item:
+                result[key] = pickle.loads(item[0])
+        return result
+
+    def set(self, key, value, time=0, namespace=None):
+        record_rpc('memcache', 'Set')
+        self._data[key] = (pickle.dumps(value, 2), self._expiry(time))
+        return True
+
+    def set_multi(self, mapping, time=0, key_prefix='', namespace=None):
+        record_rpc('memcache', 'Set')
+        for key, value in mapping.iteritems():
+            self._data[key_prefix + key] = (pickle.dumps(value, 2),
+                                            self._expiry(time))
+        return []
+
+    def add(self, key, value, time=0, namespace=None):
+        record_rpc('memcache', 'Set')
+        if self._live(key) or self._locks.get(key, 0) > self._now():
+            return False
+        self._data[key] = (pickle.dumps(value, 2), self._expiry(time))
+        return True
+
+    def delete(self, key, seconds=0, namespace=None):
+        record_rpc('memcache', 'Delete')
+        if seconds:
+            self._locks[key] = self._now() + seconds
+        return 2 if self._data.pop(key, None) else 1
+
+    def delete_multi(self, keys, seconds=0, key_prefix='', namespace=None):
+        record_rpc('memcache', 'Delete')
+        for key in keys:
+            if seconds:
+                self._locks[key_prefix + key] = self._now() + seconds
+            self._data.pop(key_prefix + key, None)
+        return True
+
+    def _offset(self, key, delta, initial_value):
+        item = self._live(key)
+        if item is None:
+            if initial_value is None:
+                return None
+            value, expires = initial_value, 0
+        else:
+            value, expires = pickle.loads(item[0]), item[1]
+        value = max(0, value + delta)
+        self._data[key] = (pickle.dumps(value, 2), expires)
+        return value
+
+    def incr(self, key, delta=1, namespace=None, initial_value=None):
+        record_rpc('memcache', 'Increment')
+        return self._offset(key, delta, initial_value)
+
+    def decr(self, key, delta=1, namespace=None, initial_value=None):
+        record_rpc('memcache', 'Increment')
+        return self._offset(key, -delta, initial_value)
+
+    def offset_multi(self, mapping, key_prefix='', namespace=None,
+                     initial_value=None):
+        record_rpc('memcache', 'Increment')
+        return dict((key, self._offset(key_prefix + key, delta,
+                                       initial_value))
+                    for key, delta in mapping.iteritems())
+
+    def flush_all(self):
+        self._data.clear()
+        self._locks.clear()
+        return True
+
+
+memcache = _Memcache()
+
+
+class Client(object):
+    """Mirrors memcache.Client for gets() and cas(); other calls go to the
+    shared fake memcache. cas() succeeds only if the value is still the one
+    this client last read with gets()."""
+    def __init__(self, *args, **kwargs):
+        self._read = {}
+
+    def __getattr__(self, name):
+        return getattr(memcache, name)
+
+    def gets(self, key, namespace=None):
+        record_rpc('memcache', 'Get')
+        item = memcache._live(key)
+        if item is None:
+            self._read.pop(key, None)
+            return None
+        self._read[key] = item
+        return pickle.loads(item[0])
+
+    def cas(self, key, value, time=0, namespace=None):
+        record_rpc('memcache', 'Set')
+        item = self._read.pop(key, None)
+        if item is None or memcache._live(key) is not item:
+            return False
+        memcache._data[key] = (pickle.dumps(value, 2),
+                               memcache._expiry(time))
+        return True
+
+
+def build_memcache():
+    module = _module('google.appengine.api.memcache', 'Fake memcache')
+    for name in ('get', 'get_multi', 'set', 'set_multi', 'add', 'delete',
+                 'delete_multi', 'incr', 'decr', 'offset_multi', 'flush_all'):
+        setattr(module, name, getattr(memcache, name))
+    module.Client = Client
+    return module
+
+
+# -- taskqueue --------------------------------------------------------------
+
+class TaskQueueError(Exception):
+    pass
+
+
+class TaskAlreadyExistsError(TaskQueueError):
+    pass
+
+
+class TombstonedTaskError(TaskQueueError):
+    pass
+
+
+class BadTransactionStateError(TaskQueueError):
+    pass
+
+
+class Task(object):
+    def __init__(self, payload=None, url=None, params=None, name=None,
+                 countdown=None, eta=None, method='POST', headers=None,
+                 **kwargs):
+        self.payload = payload
+        self.url = url
+        self.params = dict(params or {})
+        self.name = name
+        self.countdown = countdown
+        self.eta = eta
+        self.method = method
+        self.headers = headers or {}
+
+
+class _TaskQueue(object):
+    """Records enqueued tasks; the benchmark runner drains them through the
+    webapp2 app, like the task queue service would. Transactional tasks are
+    held by the current datastore transaction until it commits."""
+    def __init__(self):
+        self.pending = []
+        self.names = set()
+        # Set by the fake ndb: returns the current transaction, or None
+        self.current_transaction = lambda: None
+
+    def reset(self):
+        del self.pending[:]
+        self.names.clear()
+
+    def _add(self, task, transactional=False):
+        record_rpc('taskqueue', 'BulkAdd')
+        txn = self.current_transaction() if transactional else None
+        if txn is not None:
+            if task.name:
+                raise BadTransactionStateError(
+                    'Transactional tasks cannot be named')
+            txn.tasks.append(task)
+            return task
+        return self._enqueue(task)
+
+    def _enqueue(self, task):
+        if task.name:
+            if task.name in self.names:
+                raise TaskAlreadyExistsError(task.name)
+            self.names.add(task.name)
+        self.pending.append(task)
+        return task
+
+    def add(self, url=None, params=None, name=None, countdown=None, eta=None,
+            queue_name='default', method='POST', payload=None,
+            transactional=False, **kwargs):
+        return self._add(Task(payload=payload, url=url, params=params,
+                              name=name, countdown=countdown, eta=eta,
+                              method=method), transactional)
+
+    def pop_all(self):
+        tasks = list(self.pending)
+        del self.pending[:]
+        return tasks
+
+
+taskqueue = _TaskQueue()
+
+
+class Queue(object):
+    def __init__(self, name='default'):
+        self.name = name
+
+    def add(self, task, transactional=False):
+        tasks = task if isinstance(task, (list, tuple)) else [task]
+        for t in tasks:
+            taskqueue._add(t, transactional)
+        return task
+
+
+def build_taskqueue():
+    module = _module('google.appengine.api.taskqueue', 'Fake taskqueue')
+    module.add = taskqueue.add
+    module.Task = Task
+    module.Queue = Queue
+    module.Error = TaskQueueError
+    module.TaskAlreadyExistsError = TaskAlreadyExistsError
+    module.BadTransactionStateError = BadTransactionStateError
+    module.TombstonedTaskError = TombstonedTaskError
+    return module
+
+
+# -- mail / app_identity / oauth --------------------------------------------
+
+outbox = []
+
+
+def send_mail(sender, to, subject, body, **kwargs):
+    record_rpc('mail', 'Send')
+    outbox.append((sender, to, subject, body))
+
+
+def build_mail():
+    module = _module('google.appengine.api.mail', 'Fake mail')
+    module.send_mail = send_mail
+    return module
+
+
+def build_app_identity():
+    module = _module('google.appengine.api.app_identity',
+                     'Fake app_identity')
+    module.get_application_id = lambda: 'hangman'
+    module.get_default_gcs_bucket_name = lambda: 'hangman.appspot.com'
+    return module
+
+
+class OAuthRequestError(Exception):
+    pass
+
+
+admin = {'is_admin': True}
+
+
+def build_oauth():
+    module = _module('google.appengine.api.oauth', 'Fake oauth')
+    module.Error = OAuthRequestError
+    module.OAuthRequestError = OAuthRequestError
+
+    def is_current_user_admin(_scope=None):
+        return admin['is_admin']
+    module.is_current_user_admin = is_current_user_admin
+    return module
+
+
+def reset():
+    """Clears all service state between benchmark scenarios."""
+    memcache.reset()
+    taskqueue.reset()
+    del outbox[:]
+    rpc_counts.clear()
@@ -0,0 +1,123 @@
+"""harness.py - Drives the Hangman API and task handlers against the
+in-memory fakes, timing each call and counting the RPCs it makes."""
+
+import time
+from collections import defaultdict
+
+from . import fakes
+
+fakes.install()
+
+from google.appengine.api import apiproxy_stub_map  # noqa: E402
+from google.appengine.ext import ndb  # noqa: E402
+import webapp2  # noqa: E402
+
+import api  # noqa: E402
+import main  # noqa: E402
+from .fakes import services  # noqa: E402
+
+# RPCs reported per operation, as (service, call) pairs and column titles
+COLUMNS = [
+    (('datastore_v3', 'Get'), 'get'),
+    (('datastore_v3', 'Put'), 'put'),
+    (('datastore_v3', 'RunQuery'), 'query'),
+    (('datastore_v3', 'Commit'), 'commit'),
+    (('memcache', None), 'memcache'),
+    (('taskqueue', None), 'tasks'),
+]
+
+
+def percentile(samples, pct):
+    """Returns the pct-th percentile of an already sorted list"""
+    if not samples:
+        return 0.0
+    index = min(len(samples) - 1, int(round(pct / 100.0 * len(samples))))
+    return samples[index]
+
+
+class Recorder(object):
+    """Collects latency samples and RPC counts per operation name"""
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.rpcs = defaultdict(lambda: defaultdict(int))
+        self._current = None
+        apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+            'benchmark-recorder', self._hook)
+
+    def _hook(self, service, call, request, response):
+        if self._current is not None:
+            self.rpcs[self._current][(service, call)] += 1
+
+    def measure(self, name, func, *args, **kwargs):
+        """Runs func as one request, recording it under name"""
+        # Each request starts with an empty ndb context cache
+        ndb.get_context().clear_cache()
+        self._current = name
+        start = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.latencies[name].append(time.time() - start)
+            self._current = None
+
+    def rows(self):
+        """Yields one summary row per operation, in name order"""
+        for name in sorted(self.latencies):
+            samples = sorted(self.latencies[name])
+            count = len(samples)
+            total = sum(samples)
+            row = {
+                'name': name,
+                'count': count,
+                'ops_per_sec': count / total if total else float('inf'),
+                'p50': percentile(samples, 50) * 1000,
+                'p95': percentile(samples, 95) * 1000,
+                'p99': percentile(samples, 99) * 1000,
+            }
+            for (service, call), title in COLUMNS:
+                calls = sum(n for (s, c), n in self.rpcs[name].items()
+                            if s == service and call in (None, c))
+                row[title] = float(calls) / count
+            yield row
+
+    def report(self):
+        """Returns the summary as a fixed-width text table"""
+        titles = [title for _, title in COLUMNS]
+        header = ('{:<36} {:>6} {:>9} {:>8} {:>8} {:>8}'.format(
+            'operation', 'count', 'ops/sec', 'p50 ms', 'p95 ms', 'p99 ms') +
+            ''.join(' {:>11}'.format(t + '/op') for t in titles))
+        lines = [header, '-' * len(header)]
+        for row in self.rows():
+            lines.append(
+                '{name:<36} {count:>6} {ops_per_sec:>9.1f} {p50:>8.2f} '
+                '{p95:>8.2f} {p99:>8.2f}'.format(**row) +
+                ''.join(' {:>11.2f}'.format(row[t]) for t in titles))
+        return '\n'.join(lines)
+
+
+class Client(object):
+    """Calls API methods and runs queued tasks, recording each call"""
+    def __init__(self, recorder):
+        self.recorder = recorder
+        self.service = api.HangmanApi()
+
+    def call(self, method, container=None, **fields):
+        message_class = getattr(container, 'combined_message_class',
+                                container)
+        request = message_class(**fields) if message_class else None
+        return self.recorder.measure(method, getattr(self.service, method),
+                                     request)
+
+    def handler(self, path, method='get', params=None):
+        """Runs the webapp2 handler for path, as cron would"""
+        handler = main.app.handler_for(path)(webapp2.Request(path, params))
+        return self.recorder.measure(
+            '{} {}'.format(method.upper(), path),
+            getattr(handler, method.lower()))
+
+    def run_tasks(self):
+        """Runs queued tasks, including those they enqueue, until the queue
+        is empty. Countdowns are ignored."""
+        while services.taskqueue.pending:
+            for task in services.taskqueue.pop_all():
+                self.handler(task.url, task.method, task.params)
@@ -0,0 +1,93 @@
+"""scenarios.py - Load scenarios for the benchmark runner."""
+
+import random
+import string
+
+from .harness import Client, api
+
+# Guess order used by the simulated players
+LETTER_FREQUENCY = 'etaoinshrdlucmfwypvbgkjqxz'
+
+
+def random_word(rng, min_length=4, max_length=10):
+    length = rng.randint(min_length, max_length)
+    return u''.join(rng.choice(string.ascii_lowercase) for _ in range(length))
+
+
+def create_users(client, count):
+    names = [u'user{}'.format(i) for i in range(count)]
+    for name in names:
+        client.call('create_user', api.USER_REQUEST, user_name=name,
+                    email=u'{}@example.com'.format(name))
+    return names
+
+
+def play_game(client, rng, user_name, attempts=9):
+    """Starts a game and guesses letters, most frequent first, until it
+    ends. Some players give up part way and cancel, and some send all their
+    guesses in one make_moves call."""
+    game = client.call('new_game', api.NEW_GAME_REQUEST, user_name=user_name,
+                       answer_word=random_word(rng), attempts=attempts)
+    key = game.urlsafe_key
+    if rng.random() < 0.2:
+        # A bot submitting all of its guesses at once
+        client.call('make_moves', api.MAKE_MOVES_REQUEST,
+                    urlsafe_game_key=key,
+                    guesses=[unicode(letter) for letter in LETTER_FREQUENCY])
+        return key
+    quit_after = rng.randint(1, 8) if rng.random() < 0.1 else None
+    for turn, letter in enumerate(LETTER_FREQUENCY):
+        if turn == quit_after:
+            client.call('cancel_game', api.GET_GAME_REQUEST,
+                        urlsafe_game_key=key)
+            break
+        game = client.call('make_move', api.MAKE_MOVE_REQUEST,
+                           urlsafe_game_key=key, guess=unicode(letter))
+        if game.game_over:
+            break
+        if rng.random() < 0.2:
+            client.call('get_game', api.GET_GAME_REQUEST,
+                        urlsafe_game_key=key)
+        if rng.random() < 0.1:
+            client.call('get_hint', api.GET_GAME_REQUEST,
+                        urlsafe_game_key=key)
+    return key
+
+
+def leave_active_games(client, rng, names, count):
+    """Starts games in one new_games batch and leaves them unfinished, for
+    the reminder cron"""
+    games = client.call('new_games', api.NEW_GAMES_REQUEST, games=[
+        api.NewGameForm(user_name=rng.choice(names),
+                        answer_word=random_word(rng))
+        for _ in range(count)])
+    for game in games.items:
+        client.call('make_move', api.MAKE_MOVE_REQUEST,
+                    urlsafe_game_key=game.urlsafe_key, guess=u'e')
+
+
+def read_endpoints(client, rng, names, repeat):
+    for _ in range(repeat):
+        client.call('get_high_scores', api.LIST_REQUEST,
+                    number_of_results=10)
+        client.call('get_user_rankings', api.RANKING_REQUEST,
+                    number_of_results=10)
+        client.call('get_scores', api.PAGE_REQUEST, page_size=20)
+        client.call('get_user_games', api.USER_GAMES_REQUEST,
+                    user_name=rng.choice(names))
+        client.call('get_average_attempts')
+
+
+def run(recorder, users=50, games=500, active=100, reads=50, seed=0):
+    """Runs the full load: users, played games, unfinished games, reads,
+    queued tasks and the reminder cron"""
+    rng = random.Random(seed)
+    client = Client(recorder)
+    names = create_users(client, users)
+    for _ in range(games):
+        play_game(client, rng, rng.choice(names))
+    leave_active_games(client, rng, names, active)
+    client.run_tasks()
+    read_endpoints(client, rng, names, reads)
+    client.handler('/crons/send_reminder')
+    client.run_tasks()
@@ -0,0 +1,73 @@
+"""Plays every word of a word list against many guess strategies with the
+vectorized engine, and prints win rates and attempts used.
+
+Usage (from the project root, with Python 2.7 and NumPy):
+    python -m benchmarks.simulate WORDLIST [--strategies N]
+        [--attempts A [A ...]] [--worst W] [--seed S]
+
+WORDLIST has one answer per line. The strategies are the English letter
+frequency order plus N random orders of the alphabet.
+"""
+
+import argparse
+import io
+import sys
+import time
+
+import engine
+
+
+def read_words(path):
+    with io.open(path, encoding='utf-8') as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.simulate')
+    parser.add_argument('wordlist')
+    parser.add_argument('--strategies', type=int, default=100,
+                        help='random guess orders, besides letter frequency')
+    parser.add_argument('--attempts', type=int, nargs='+', default=[9],
+                        help='attempts allowed; the first is used per word')
+    parser.add_argument('--worst', type=int, default=20,
+                        help='words with the lowest win rate to list, '
+                             '0 for all')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    words = read_words(args.wordlist)
+    strategies = [engine.FREQUENCY_ORDER] + engine.random_strategies(
+        args.strategies, args.seed)
+    start = time.time()
+    try:
+        result = engine.simulate(words, strategies)
+    except ValueError as e:
+        print(e)
+        return 1
+    elapsed = time.time() - start
+    print('{} words x {} strategies = {} games in {:.2f}s'.format(
+        len(words), len(strategies), len(words) * len(strategies), elapsed))
+
+    print('\n{:>8} {:>9} {:>13}'.format('attempts', 'win rate',
+                                        'attempts used'))
+    for attempts in args.attempts:
+        print('{:>8} {:>9.3f} {:>13.2f}'.format(
+            attempts, result.overall_win_rate(attempts),
+            result.guesses_used(attempts).mean()))
+
+    attempts = args.attempts[0]
+    win_rates = result.win_rate(attempts)
+    guesses_used = result.guesses_used(attempts)
+    order = win_rates.argsort(kind='mergesort')
+    if args.worst:
+        order = order[:args.worst]
+    print('\n{:<24} {:>9} {:>13}  (attempts={})'.format(
+        'word', 'win rate', 'attempts used', attempts))
+    for i in order:
+        print(u'{:<24} {:>9.3f} {:>13.2f}'.format(
+            words[i], win_rates[i], guesses_used[i]))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,207 @@
+"""bulk.py - Bulk export and import of Users, Games and Scores.
+
+Each kind is exported by its own chain of tasks on the bulk queue. A task
+reads one batch of BATCH_SIZE entities from a query cursor and writes it to
+its own part file as newline-delimited JSON, then enqueues the next batch
+with the new cursor. A task that runs past its deadline is retried and
+rewrites the same part, so an export resumes where it stopped.
+
+Parts are written to Cloud Storage when EXPORT_BUCKET is set and the
+cloudstorage library is installed, and under EXPORT_DIR on local disk
+otherwise (the dev server and the benchmarks). Importing reads the parts
+back in order and writes each with one put_multi, keeping the original
+keys. Keys are saved as their kind and id path rather than urlsafe, which
+names the source app, so an export can be imported into another app."""
+
+import datetime
+import io
+import json
+import os
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+try:
+    import cloudstorage
+except ImportError:
+    cloudstorage = None
+
+import counters
+from models import User, Game, Score, Leaderboard, ACTIVE_GAMES,\
+    ATTEMPTS_REMAINING
+
+KINDS = {'User': User, 'Game': Game, 'Score': Score}
+BATCH_SIZE = 500
+QUEUE = 'bulk'
+EXPORT_BUCKET = None
+EXPORT_DIR = 'exports'
+
+
+class ImportedBatch(ndb.Model):
+    """Marks an imported batch of Games whose active games have been added
+    to the counters, so a retried task adds nothing twice"""
+
+
+def part_path(export_id, kind, batch):
+    return '{}/{}/{:05d}.json'.format(export_id, kind, batch)
+
+
+def _open(path, mode):
+    if EXPORT_BUCKET and cloudstorage:
+        return cloudstorage.open('/{}/{}'.format(EXPORT_BUCKET, path), mode,
+                                 content_type='application/x-ndjson')
+    path = os.path.join(EXPORT_DIR, path)
+    if mode == 'w' and not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    return io.open(path, mode + 'b')
+
+
+def _exists(path):
+    if EXPORT_BUCKET and cloudstorage:
+        try:
+            cloudstorage.stat('/{}/{}'.format(EXPORT_BUCKET, path))
+            return True
+        except cloudstorage.NotFoundError:
+            return False
+    return os.path.exists(os.path.join(EXPORT_DIR, path))
+
+
+def _to_json_value(value):
+    if isinstance(value, ndb.Key):
+        return list(value.flat())
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    return value
+
+
+def _from_json_value(prop, value):
+    if isinstance(prop, ndb.KeyProperty):
+        return ndb.Key(flat=value)
+    if isinstance(prop, ndb.DateProperty):
+        return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+    if isinstance(prop, ndb.DateTimeProperty):
+        return datetime.datetime.strptime(
+            value, '%Y-%m-%dT%H:%M:%S.%f' if '.' in value
+            else '%Y-%m-%dT%H:%M:%S')
+    return value
+
+
+def to_json(entity):
+    """Returns one line of JSON holding the entity's key and stored
+    properties"""
+    row = {'__key__': list(entity.key.flat())}
+    for name, prop in entity._properties.items():
+        if isinstance(prop, ndb.ComputedProperty):
+            continue
+        value = getattr(entity, name)
+        if prop._repeated:
+            value = [_to_json_value(item) for item in value]
+        else:
+            value = _to_json_value(value)
+        row[name] = value
+    return json.dumps(row, separators=(',', ':'), sort_keys=True)
+
+
+def from_json(model, line):
+    """Returns an unsaved entity of model from a line written by to_json"""
+    row = json.loads(line)
+    key = ndb.Key(flat=row.pop('__key__'))
+    values = {}
+    for name, value in row.items():
+        prop = model._properties.get(name)
+        if prop is None:
+            continue
+        if prop._repeated:
+            value = [_from_json_value(prop, item) for item in value or []]
+        elif value is not None:
+            value = _from_json_value(prop, value)
+        values[name] = value
+    return model(key=key, **values)
+
+
+def _enqueue(url, run, export_id, kind, batch, cursor=None):
+    """Adds the task for one batch of a run, named so that a batch is never
+    enqueued twice"""
+    params = {'run': run, 'export_id': export_id, 'kind': kind,
+              'batch': batch}
+    if cursor:
+        params['cursor'] = cursor.urlsafe()
+    try:
+        taskqueue.add(url=url, params=params, queue_name=QUEUE,
+                      name='{}-{}-{}'.format(run, kind, batch))
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+def _run_id(prefix):
+    return '{}-{}'.format(prefix,
+                          datetime.datetime.utcnow().strftime('%Y%m%d%H%M%S'))
+
+
+def start_export():
+    """Starts exporting every kind and returns the export id"""
+    export_id = _run_id('export')
+    for kind in KINDS:
+        _enqueue('/tasks/export', export_id, export_id, kind, 0)
+    return export_id
+
+
+def export_batch(run, export_id, kind, batch, cursor=None):
+    """Writes one batch of kind to its part file and enqueues the next"""
+    entities, cursor, more = KINDS[kind].query().fetch_page(
+        BATCH_SIZE, start_cursor=cursor)
+    with _open(part_path(export_id, kind, batch), 'w') as f:
+        for entity in entities:
+            f.write(to_json(entity) + '\n')
+    if more:
+        _enqueue('/tasks/export', run, export_id, kind, batch + 1, cursor)
+
+
+def start_import(export_id):
+    """Starts importing every kind of an export and returns the run id"""
+    run = _run_id('import')
+    for kind in KINDS:
+        _enqueue('/tasks/import', run, export_id, kind, 0)
+    return run
+
+
+def import_batch(run, export_id, kind, batch):
+    """Writes the entities of one part file with a single put_multi and
+    enqueues the next part. Active Games are added to the counters, and the
+    leaderboard is rebuilt once every Score part is in"""
+    path = part_path(export_id, kind, batch)
+    if not _exists(path):
+        if kind == 'Score':
+            Leaderboard.rebuild()
+        return
+    model = KINDS[kind]
+    with _open(path, 'r') as f:
+        entities = [from_json(model, line) for line in f if line.strip()]
+    ids = [entity.key.id() for entity in entities
+           if isinstance(entity.key.id(), (int, long))]
+    if ids:
+        # Keep the datastore from assigning these ids to new entities
+        model.allocate_ids(max=max(ids))
+    if kind == 'Game':
+        # Every active game imported is added to the counters below
+        for game in entities:
+            if not game.game_over:
+                game.counted = True
+        Game.put_multi(entities)
+    else:
+        ndb.put_multi(entities)
+    if kind == 'Game':
+        marker_key = ndb.Key(ImportedBatch, '{}-{}'.format(run, batch))
+        _count_active_games(marker_key, [game for game in entities
+                                         if not game.game_over])
+    _enqueue('/tasks/import', run, export_id, kind, batch + 1)
+
+
+@ndb.transactional(xg=True)
+def _count_active_games(marker_key, games):
+    if marker_key.get():
+        return
+    ImportedBatch(key=marker_key).put()
+    counters.increment({
+        ACTIVE_GAMES: len(games),
+        ATTEMPTS_REMAINING: sum(game.attempts_remaining for game in games)})
@@ -0,0 +1,165 @@
+"""cache.py - Read-through cache for hot entities, used by get_by_urlsafe.
+
+Decoded urlsafe keys and recently used entities are kept in bounded
+in-process LRU caches, with memcache behind them. Models opt in by setting
+_use_entity_cache and calling put() from their _post_put_hook, so every
+write outside a transaction refreshes both layers. Transactions on different
+instances may reach the cache in another order than they committed, so after
+one commits the entity is stored with put_if_newer(), which compares
+versions, or dropped with invalidate(). Reads from the datastore fill the
+cache with add(), which never replaces a cached copy.
+
+Other instances may serve an in-process copy for up to ENTITY_TTL seconds
+after it changed, so cached entities are for reading only: code that changes
+an entity reads it again in a transaction, and get() always misses inside
+one."""
+
+import cPickle as pickle
+import threading
+import time
+from collections import OrderedDict
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+KEY_CACHE_SIZE = 1024
+ENTITY_CACHE_SIZE = 256
+# Seconds an in-process copy of an entity is trusted
+ENTITY_TTL = 5
+# Seconds an entity is kept in memcache
+MEMCACHE_TTL = 600
+MEMCACHE_PREFIX = 'ENTITY:'
+# Seconds after invalidate() during which add() leaves memcache empty, so a
+# read that started before the write cannot store the old entity
+INVALIDATE_LOCK = 2
+# Compare-and-set attempts made by put_if_newer()
+CAS_ATTEMPTS = 3
+
+
+class LRUCache(object):
+    """A thread-safe mapping that holds at most max_size items, evicting the
+    least recently used, and optionally expires items after ttl seconds"""
+    def __init__(self, max_size, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.pop(key, None)
+            if item is None:
+                return None
+            value, expires = item
+            if expires is not None and expires <= time.time():
+                return None
+            self._items[key] = item
+            return value
+
+    def set(self, key, value):
+        expires = time.time() + self.ttl if self.ttl else None
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = (value, expires)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+_keys = LRUCache(KEY_CACHE_SIZE)
+_entities = LRUCache(ENTITY_CACHE_SIZE, ttl=ENTITY_TTL)
+
+
+def decode_key(urlsafe):
+    """Returns the ndb.Key for a urlsafe string, decoding each string once.
+    Raises the same errors as ndb.Key(urlsafe=...)"""
+    key = _keys.get(urlsafe)
+    if key is None:
+        key = ndb.Key(urlsafe=urlsafe)
+        _keys.set(urlsafe, key)
+    return key
+
+
+def get(key):
+    """Returns a private copy of the cached entity for key, or None on a
+    miss. Always misses in a transaction, which must read the datastore"""
+    if ndb.in_transaction():
+        return None
+    urlsafe = key.urlsafe()
+    data = _entities.get(urlsafe)
+    if data is None:
+        data = memcache.get(MEMCACHE_PREFIX + urlsafe)
+        if data is None:
+            return None
+        _entities.set(urlsafe, data)
+    # Every caller gets its own instance, as entities are mutable
+    return pickle.loads(data)
+
+
+def put(entity):
+    """Stores entity in both cache layers"""
+    urlsafe = entity.key.urlsafe()
+    data = pickle.dumps(entity, pickle.HIGHEST_PROTOCOL)
+    _entities.set(urlsafe, data)
+    memcache.set(MEMCACHE_PREFIX + urlsafe, data, time=MEMCACHE_TTL)
+
+
+def put_multi(entities):
+    """Stores entities in both cache layers, with one memcache call"""
+    mapping = {}
+    for entity in entities:
+        urlsafe = entity.key.urlsafe()
+        data = pickle.dumps(entity, pickle.HIGHEST_PROTOCOL)
+        _entities.set(urlsafe, data)
+        mapping[urlsafe] = data
+    if mapping:
+        memcache.set_multi(mapping, time=MEMCACHE_TTL,
+                           key_prefix=MEMCACHE_PREFIX)
+
+
+def add(entity):
+    """Stores an entity just read from the datastore, unless memcache already
+    holds it or it was invalidated in the last INVALIDATE_LOCK seconds"""
+    urlsafe = entity.key.urlsafe()
+    data = pickle.dumps(entity, pickle.HIGHEST_PROTOCOL)
+    if memcache.add(MEMCACHE_PREFIX + urlsafe, data, time=MEMCACHE_TTL):
+        _entities.set(urlsafe, data)
+
+
+def put_if_newer(entity, version):
+    """Stores entity unless memcache holds a copy whose version(copy) is
+    greater. Used once a transaction has committed; if another request keeps
+    changing the copy, the key is invalidated instead"""
+    urlsafe = entity.key.urlsafe()
+    data = pickle.dumps(entity, pickle.HIGHEST_PROTOCOL)
+    client = memcache.Client()
+    for _ in range(CAS_ATTEMPTS):
+        cached = client.gets(MEMCACHE_PREFIX + urlsafe)
+        if cached is None:
+            stored = client.add(MEMCACHE_PREFIX + urlsafe, data,
+                                time=MEMCACHE_TTL)
+        elif version(pickle.loads(cached)) > version(entity):
+            _entities.delete(urlsafe)
+            return
+        else:
+            stored = client.cas(MEMCACHE_PREFIX + urlsafe, data,
+                                time=MEMCACHE_TTL)
+        if stored:
+            _entities.set(urlsafe, data)
+            return
+    invalidate(entity.key)
+
+
+def invalidate(key):
+    """Drops key from both cache layers, and keeps add() from storing it
+    again for INVALIDATE_LOCK seconds"""
+    urlsafe = key.urlsafe()
+    _entities.delete(urlsafe)
+    memcache.delete(MEMCACHE_PREFIX + urlsafe, seconds=INVALIDATE_LOCK)
@@ -0,0 +1,70 @@
+"""counters.py - Sharded counters for totals that many requests update at
+once. Each counter is split over NUM_SHARDS entities so that concurrent
+increments rarely contend; reading a counter sums its shards.
+
+Moves write a shard inside their own transaction, so a shard that two moves
+pick at once makes one of them retry, with another random shard. Each shard
+takes about one write a second, so NUM_SHARDS should be well above the
+number of counter writes per second at peak. It may be raised at any time,
+but lowering it leaves the counts of the dropped shards out."""
+
+import random
+
+from google.appengine.ext import ndb
+
+NUM_SHARDS = 200
+
+
+class CounterShard(ndb.Model):
+    """One shard of a named counter"""
+    count = ndb.IntegerProperty(default=0, indexed=False)
+
+
+def _shard_key(name, index):
+    return ndb.Key(CounterShard, '{}-{}'.format(name, index))
+
+
+def increment(deltas):
+    """Adds to one or more counters in a single transaction
+    Args:
+        deltas: A dict of counter name to the amount to add to it."""
+    increment_async(deltas).get_result()
+
+
+@ndb.tasklet
+def increment_async(deltas):
+    """Asynchronous version of increment(), returning a Future"""
+    @ndb.transactional_tasklet(xg=True)
+    def txn():
+        shards = yield incremented_shards_async(deltas)
+        yield ndb.put_multi_async(shards)
+    if any(deltas.values()):
+        yield txn()
+
+
+@ndb.tasklet
+def incremented_shards_async(deltas):
+    """Reads one randomly chosen shard of each counter and adds to it,
+    returning a Future for the unsaved shards. Call it in a cross-group
+    transaction that puts the shards along with the caller's own writes"""
+    deltas = dict((name, delta) for name, delta in deltas.items() if delta)
+    index = random.randint(0, NUM_SHARDS - 1)
+    keys = [_shard_key(name, index) for name in deltas]
+    shards = yield ndb.get_multi_async(keys)
+    for i, name in enumerate(deltas):
+        if shards[i] is None:
+            shards[i] = CounterShard(key=keys[i])
+        shards[i].count += deltas[name]
+    raise ndb.Return(shards)
+
+
+def get_counts(names):
+    """Returns a dict of counter name to its current value"""
+    keys = [_shard_key(name, index)
+            for name in names for index in range(NUM_SHARDS)]
+    shards = ndb.get_multi(keys)
+    counts = dict((name, 0) for name in names)
+    for key, shard in zip(keys, shards):
+        if shard:
+            counts[key.id().rsplit('-', 1)[0]] += shard.count
+    return counts
@@ -0,0 +1,179 @@
+"""engine.py - Hangman rules, independent of storage.
+
+Game.make_guess keeps a game's state in the datastore and applies each guess
+with play(). simulate() plays many games at once over NumPy arrays, for
+tuning the number of attempts and vetting word lists offline. NumPy is only
+imported by simulate(), so the API does not need it."""
+
+import random
+
+# Outcomes of a guess
+REPEAT = 'repeat'
+HIT = 'hit'
+MISS = 'miss'
+WIN = 'win'
+LOSE = 'lose'
+
+ALPHABET = u'abcdefghijklmnopqrstuvwxyz'
+# English letters, most frequent first
+FREQUENCY_ORDER = u'etaoinshrdlucmfwypvbgkjqxz'
+
+
+def letter_positions(answer):
+    """Maps each letter of the answer to a bitmask of its positions"""
+    positions = {}
+    for i, letter in enumerate(answer):
+        positions[letter] = positions.get(letter, 0) | 1 << i
+    return positions
+
+
+def letter_bit(guess):
+    """Returns the bit for a guess of one letter a-z in a mask of guessed
+    letters, or 0 for any other guess"""
+    if len(guess) == 1 and u'a' <= guess <= u'z':
+        return 1 << (ord(guess) - ord(u'a'))
+    return 0
+
+
+def is_solved(answer, revealed):
+    return revealed == (1 << len(answer)) - 1
+
+
+def render(answer, revealed):
+    """The answer with every unrevealed letter shown as '*'"""
+    # bin() lists the mask most significant bit first; reverse it so that
+    # bit i lines up with answer[i]
+    bits = bin(revealed)[:1:-1].ljust(len(answer), '0')
+    return ''.join(letter if bit == '1' else '*'
+                   for letter, bit in zip(answer, bits))
+
+
+def play(answer, positions, revealed, attempts_remaining, guess):
+    """Applies a guess that has not been made before to a game in play.
+    Returns the outcome with the new revealed mask and attempts remaining.
+    Raises ValueError for a blank guess"""
+    # user can enter either a letter or a word into the guess field.
+    # if letter, check to see if letter is in word or not.
+    # if word, check to see if word matches answer.
+    if len(guess) == 0:
+        raise ValueError('Guess cannot be blank')
+    elif len(guess) == 1:
+        hit = positions.get(guess, 0)
+        revealed |= hit
+        # once every position is revealed the word has been guessed
+        if hit and is_solved(answer, revealed):
+            return WIN, revealed, attempts_remaining
+    else:
+        hit = guess == answer
+        if hit:
+            return WIN, revealed, attempts_remaining
+    if hit:
+        return HIT, revealed, attempts_remaining
+    attempts_remaining -= 1
+    if attempts_remaining < 1:
+        return LOSE, revealed, attempts_remaining
+    return MISS, revealed, attempts_remaining
+
+
+def message(outcome, guess, answer, revealed):
+    """Returns the message shown to the player for the outcome of a guess"""
+    if outcome == REPEAT:
+        return 'You already guessed ' + guess
+    if outcome == WIN:
+        prefix = 'You win!' if len(guess) == 1 else 'Hooray! You win!'
+        return prefix + ' The answer is: ' + answer
+    if outcome == LOSE:
+        return 'Game over!'
+    field = render(answer, revealed)
+    if outcome == HIT:
+        return 'You got one! Keep guessing: ' + field
+    if len(guess) == 1:
+        return 'Nope! ' + guess + ' is not in the answer. ' \
+               'Keep guessing: ' + field
+    return 'Nope! ' + guess + ' is not the answer. Keep guessing: ' + field
+
+
+def random_strategies(count, seed=None):
+    """Returns count guess orders, each a shuffled alphabet"""
+    rng = random.Random(seed)
+    strategies = []
+    for _ in range(count):
+        letters = list(ALPHABET)
+        rng.shuffle(letters)
+        strategies.append(u''.join(letters))
+    return strategies
+
+
+class SimulationResult(object):
+    """Outcome of every answer played with every strategy.
+
+    misses[i, j] is the number of wrong guesses made before answers[i] was
+    solved by strategies[j], or UNSOLVED if the strategy ran out of letters
+    first, which counts as a loss with every attempt used. A game allowed n
+    attempts is won when misses < n, so one simulation answers for any
+    number of attempts."""
+    UNSOLVED = 2 ** 31
+
+    def __init__(self, answers, strategies, misses, turns):
+        self.answers = answers
+        self.strategies = strategies
+        self.misses = misses
+        self.turns = turns
+
+    def wins(self, attempts):
+        """Boolean array of the games won with the given attempts"""
+        return self.misses < attempts
+
+    def win_rate(self, attempts):
+        """Fraction of strategies winning each answer"""
+        return self.wins(attempts).mean(axis=1)
+
+    def guesses_used(self, attempts):
+        """Mean attempts used per answer, as recorded on a Score"""
+        return self.misses.clip(max=attempts).mean(axis=1)
+
+    def overall_win_rate(self, attempts):
+        return self.wins(attempts).mean()
+
+
+def simulate(answers, strategies):
+    """Plays every answer against every strategy, a string giving the order
+    in which letters a-z are guessed, and returns a SimulationResult. Word
+    guesses are not simulated. Raises ValueError for an answer of fewer than
+    two letters or with characters other than a-z"""
+    import numpy as np
+
+    answer_masks = np.zeros(len(answers), dtype=np.int64)
+    for i, answer in enumerate(answers):
+        bits = [letter_bit(letter) for letter in answer]
+        if len(answer) < 2 or not all(bits):
+            raise ValueError('Answers must be at least two letters a-z, '
+                             'not {!r}'.format(answer))
+        answer_masks[i] = sum(set(bits))
+    length = max(len(strategy) for strategy in strategies)
+    # Bit of the letter guessed by each strategy at each turn, 0 once the
+    # strategy runs out
+    guess_bits = np.zeros((len(strategies), length), dtype=np.int64)
+    for j, strategy in enumerate(strategies):
+        bits = [letter_bit(letter) for letter in strategy]
+        if not all(bits):
+            raise ValueError('Strategies must be letters a-z, '
+                             'not {!r}'.format(strategy))
+        guess_bits[j, :len(bits)] = bits
+
+    shape = (len(answers), len(strategies))
+    answer_masks = answer_masks[:, np.newaxis]
+    guessed = np.zeros(shape, dtype=np.int64)
+    misses = np.zeros(shape, dtype=np.int64)
+    turns = np.zeros(shape, dtype=np.int64)
+    solved = np.zeros(shape, dtype=bool)
+    for turn in range(length):
+        bit = guess_bits[:, turn]
+        # Repeated letters cost nothing, as in the game
+        new = ~solved & (bit != 0) & (guessed & bit == 0)
+        guessed |= np.where(new, bit, 0)
+        turns += new
+        misses += new & (answer_masks & bit == 0)
+        solved |= answer_masks & ~guessed == 0
+    misses[~solved] = SimulationResult.UNSOLVED
+    return SimulationResult(answers, strategies, misses, turns)
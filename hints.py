@@ -0,0 +1,124 @@
+"""hints.py - Suggests the next letter to guess, from a dictionary of words.
+
+The dictionary is indexed once per instance, by the warmup request or else
+the first hint. Words are grouped by length, and for each length, position
+and letter an integer bitset marks the words with that letter there, so the
+words that fit a game are found by intersecting bitsets. The letter counts
+over those words are cached per pattern and set of guesses."""
+
+import io
+import os
+import threading
+
+import engine
+from cache import LRUCache
+
+DICTIONARY = os.path.join(os.path.dirname(__file__), 'words.txt')
+HINT_CACHE_SIZE = 4096
+
+_index = []
+_lock = threading.Lock()
+
+
+def _count(bitset):
+    return bin(bitset).count('1')
+
+
+class WordIndex(object):
+    """Bitset index over a list of words of letters a-z"""
+    def __init__(self, words):
+        self.words = {}
+        self._positions = {}
+        # (length, letter) -> words containing the letter anywhere
+        self._contains = {}
+        # (length, position, letter) -> words with the letter there
+        self._at = {}
+        self._counts = LRUCache(HINT_CACHE_SIZE)
+        for word in sorted(set(words)):
+            if len(word) < 2 or not all(engine.letter_bit(letter)
+                                        for letter in word):
+                continue
+            length = len(word)
+            group = self.words.setdefault(length, [])
+            bit = 1 << len(group)
+            self._positions[word] = len(group)
+            group.append(word)
+            for i, letter in enumerate(word):
+                self._at[length, i, letter] = \
+                    self._at.get((length, i, letter), 0) | bit
+                self._contains[length, letter] = \
+                    self._contains.get((length, letter), 0) | bit
+
+    @classmethod
+    def load(cls, path=DICTIONARY):
+        """Builds the index from a file with one word per line"""
+        with io.open(path, encoding='utf-8') as f:
+            return cls(line.strip() for line in f)
+
+    def candidates(self, pattern, guesses):
+        """Returns the bitset of words that fit pattern, an answer with its
+        unrevealed letters shown as '*', after the given guesses"""
+        length = len(pattern)
+        group = self.words.get(length)
+        if not group:
+            return 0
+        bitset = (1 << len(group)) - 1
+        letters = set(guess for guess in guesses if len(guess) == 1)
+        for i, letter in enumerate(pattern):
+            if letter != '*':
+                bitset &= self._at.get((length, i, letter), 0)
+                if not bitset:
+                    return 0
+        for letter in letters:
+            if letter in pattern:
+                # Every occurrence of a guessed letter is revealed
+                for i, shown in enumerate(pattern):
+                    if shown == '*':
+                        bitset &= ~self._at.get((length, i, letter), 0)
+            else:
+                bitset &= ~self._contains.get((length, letter), 0)
+        for guess in guesses:
+            if len(guess) == length and guess in self._positions:
+                bitset &= ~(1 << self._positions[guess])
+        return bitset
+
+    def letter_counts(self, pattern, guesses):
+        """Returns the number of words that fit the game, and a dict of the
+        number of those words containing each letter not yet guessed"""
+        guesses = frozenset(guesses)
+        counts = self._counts.get((pattern, guesses))
+        if counts is None:
+            bitset = self.candidates(pattern, guesses)
+            letters = {}
+            if bitset:
+                for letter in engine.ALPHABET:
+                    if letter not in guesses:
+                        letters[letter] = _count(bitset & self._contains.get(
+                            (len(pattern), letter), 0))
+            counts = (_count(bitset), letters)
+            self._counts.set((pattern, guesses), counts)
+        return counts
+
+    def hint(self, pattern, guesses):
+        """Returns the letter found in the most words that fit the game, and
+        the number of those words. Without any such word, the most frequent
+        English letter not yet guessed is returned. Returns None for the
+        letter once every letter has been guessed"""
+        guesses = frozenset(guesses)
+        candidates, letters = self.letter_counts(pattern, guesses)
+        unguessed = [letter for letter in engine.FREQUENCY_ORDER
+                     if letter not in guesses]
+        if not unguessed:
+            return None, candidates
+        # Ties go to the more frequent letter
+        best = max(unguessed, key=lambda letter: letters.get(letter, 0))
+        return best, candidates
+
+
+def get_index():
+    """Returns this instance's index, building it on first use"""
+    if not _index:
+        with _lock:
+            if not _index:
+                _index.append(WordIndex.load())
+    return _index[0]
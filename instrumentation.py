@@ -0,0 +1,162 @@
+"""instrumentation.py - Latency and datastore RPC statistics per endpoint.
+
+Functions wrapped with @instrumented(name) are timed, and the datastore get,
+put and query RPCs made while they run are counted through an apiproxy hook.
+Each instance aggregates its stats in memory and adds them to memcache
+counters at most every FLUSH_INTERVAL seconds, so get_stats() reports totals
+across instances. The names flushed are also kept in a list in memcache, as
+an instance only knows the names of the modules it has imported: one that
+only serves the API has not imported the cron and task handlers."""
+
+import functools
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
+
+# Upper bounds, in milliseconds, of the latency histogram buckets. A final
+# bucket holds everything slower.
+LATENCY_BUCKETS_MS = [1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000,
+                      10000]
+FLUSH_INTERVAL = 30
+MEMCACHE_PREFIX = 'STATS:'
+NAMES_KEY = 'names'
+# Compare-and-set attempts made when adding names to the list
+CAS_ATTEMPTS = 3
+
+_RPC_FIELDS = {'Get': 'get', 'Put': 'put', 'RunQuery': 'query'}
+_BUCKETS = ['bucket{}'.format(i) for i in range(len(LATENCY_BUCKETS_MS) + 1)]
+_FIELDS = ['calls', 'get', 'put', 'query'] + _BUCKETS
+
+_names = []
+_pending = {}
+_lock = threading.Lock()
+_local = threading.local()
+_last_flush = [time.time()]
+
+
+def _datastore_hook(service, call, request, response):
+    calls = getattr(_local, 'calls', None)
+    if calls and call in _RPC_FIELDS:
+        calls[-1][_RPC_FIELDS[call]] += 1
+
+
+apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+    'instrumentation', _datastore_hook, 'datastore_v3')
+
+
+def _bucket(elapsed_ms):
+    for i, bound in enumerate(LATENCY_BUCKETS_MS):
+        if elapsed_ms <= bound:
+            return i
+    return len(LATENCY_BUCKETS_MS)
+
+
+def _record(name, elapsed_ms, rpcs):
+    with _lock:
+        stats = _pending.setdefault(name, dict.fromkeys(_FIELDS, 0))
+        stats['calls'] += 1
+        stats[_BUCKETS[_bucket(elapsed_ms)]] += 1
+        for field, count in rpcs.items():
+            stats[field] += count
+        due = time.time() - _last_flush[0] >= FLUSH_INTERVAL
+    if due:
+        flush()
+
+
+def instrumented(name):
+    """Decorator recording latency and datastore RPCs of each call under
+    name. Nested instrumented calls are only counted in the innermost."""
+    def decorator(func):
+        _names.append(name)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not hasattr(_local, 'calls'):
+                _local.calls = []
+            _local.calls.append(dict.fromkeys(_RPC_FIELDS.values(), 0))
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                rpcs = _local.calls.pop()
+                _record(name, (time.time() - start) * 1000, rpcs)
+        return wrapper
+    return decorator
+
+
+def flush():
+    """Adds this instance's unflushed stats to the memcache counters"""
+    with _lock:
+        pending = dict(_pending)
+        _pending.clear()
+        _last_flush[0] = time.time()
+    offsets = {}
+    for name, stats in pending.items():
+        for field, count in stats.items():
+            if count:
+                offsets['{}:{}'.format(name, field)] = count
+    if offsets:
+        memcache.offset_multi(offsets, key_prefix=MEMCACHE_PREFIX,
+                              initial_value=0)
+        _register(pending)
+
+
+def _register(names):
+    """Adds names to the list of flushed names in memcache, if missing"""
+    client = memcache.Client()
+    for _ in range(CAS_ATTEMPTS):
+        registered = client.gets(MEMCACHE_PREFIX + NAMES_KEY)
+        if registered is None:
+            stored = client.add(MEMCACHE_PREFIX + NAMES_KEY, sorted(names))
+        elif set(names) <= set(registered):
+            return
+        else:
+            stored = client.cas(MEMCACHE_PREFIX + NAMES_KEY,
+                                sorted(set(registered) | set(names)))
+        if stored:
+            return
+
+
+def _percentile(buckets, calls, pct):
+    """Returns the upper bound of the bucket holding the pct-th percentile,
+    or None if it falls in the overflow bucket"""
+    seen = 0
+    for i, count in enumerate(buckets):
+        seen += count
+        if seen * 100 >= calls * pct:
+            return LATENCY_BUCKETS_MS[i] if i < len(LATENCY_BUCKETS_MS) \
+                else None
+    return None
+
+
+def get_stats():
+    """Returns a list of dicts with name, calls, p50/p95/p99 latency (ms)
+    and average datastore gets, puts and queries per call, for every
+    instrumented name that has been called, on any instance"""
+    flush()
+    registered = memcache.get(MEMCACHE_PREFIX + NAMES_KEY) or []
+    names = _names + sorted(set(registered) - set(_names))
+    keys = ['{}:{}'.format(name, field)
+            for name in names for field in _FIELDS]
+    values = memcache.get_multi(keys, key_prefix=MEMCACHE_PREFIX)
+    stats = []
+    for name in names:
+        counts = dict((field, values.get('{}:{}'.format(name, field), 0))
+                      for field in _FIELDS)
+        calls = counts['calls']
+        if not calls:
+            continue
+        buckets = [counts[bucket] for bucket in _BUCKETS]
+        stats.append({
+            'name': name,
+            'calls': calls,
+            'p50_ms': _percentile(buckets, calls, 50),
+            'p95_ms': _percentile(buckets, calls, 95),
+            'p99_ms': _percentile(buckets, calls, 99),
+            'gets_per_call': float(counts['get']) / calls,
+            'puts_per_call': float(counts['put']) / calls,
+            'queries_per_call': float(counts['query']) / calls,
+        })
+    return stats
@@ -3,50 +3,312 @@
 """main.py - This file contains handlers that are called by taskqueue and/or
 cronjobs."""
 import logging
+from datetime import date, datetime, timedelta
 
 import webapp2
-from google.appengine.api import mail, app_identity
+from google.appengine.api import mail, app_identity, taskqueue
+from google.appengine.ext import ndb
 from api import HangmanApi
 
-from models import User, Game
+import bulk
+import hints
+from instrumentation import instrumented
+from models import User, Game, Score, DailyScore, ScoreRollup, Leaderboard,\
+    ARCHIVE_SCORES, COUNT_TXN_SIZE
+from utils import get_cursor
+
+# Users handled by each reminder task
+REMINDER_BATCH_SIZE = 100
+# Scores handled by each rollup or archive task
+ROLLUP_BATCH_SIZE = 500
+# Games handled by each task indexing active games on their Users
+INDEX_BATCH_SIZE = 200
+# Games read in each cross-group transaction while indexing with their User
+INDEX_TXN_SIZE = 24
+# Users handled by each task rebuilding user totals
+TOTALS_BATCH_SIZE = 50
+
+
+def _enqueue_reminders(run, batch, cursor=None):
+    """Adds the reminder task for one batch of a run. Tasks are named by run
+    and batch, so a batch is never enqueued twice."""
+    params = {'run': run, 'batch': batch}
+    if cursor:
+        params['cursor'] = cursor.urlsafe()
+    try:
+        taskqueue.add(url='/tasks/send_reminders', params=params,
+                      name='reminders-{}-{}'.format(run, batch))
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
 
 
 class SendReminderEmail(webapp2.RequestHandler):
+    @instrumented('cron.send_reminder')
     def get(self):
         """
         Send a reminder email to each User with an email about games.
         This sends each user one reminder daily if any active games. So if a
         user has two active games, she will receive only one email.
-        Called every 24 hours using a cron job
+        Called every 24 hours using a cron job; the emails are sent by a
+        chain of SendReminderBatch tasks
+        """
+        _enqueue_reminders(date.today().isoformat(), 0)
+
+
+class SendReminderBatch(webapp2.RequestHandler):
+    @instrumented('task.send_reminders')
+    def post(self):
+        """
+        Send reminders to one batch of users with active games, then enqueue
+        the next batch. Each task resumes from the query cursor it was given,
+        so a failed batch is retried without repeating earlier ones.
         """
         app_id = app_identity.get_application_id()
-        active_games = Game.query(Game.game_over == False)
-        all_users = User.query(User.email != None)
-        for user in all_users:
-            for game in active_games:
-                if user.key == game.user:
-                    subject = 'This is a reminder!'
-                    body = "Hello {}, you have at least one active" \
-                        + "hangman game!".format(user.name)
-                    # This will send test emails,
-                    # the arguments to send_mail are:
-                    # from, to, subject, body
-                    mail.send_mail('noreply@{}.appspotmail.com'.format(app_id),
-                                   user.email,
-                                   subject,
-                                   body)
-                    # once active game has been found for user, exit for loop
-                    break
+        run = self.request.get('run')
+        batch = int(self.request.get('batch'))
+        # Users keep their active games, so this reads Users directly
+        query = User.query(User.has_active_games == True)
+        users, cursor, more = query.fetch_page(
+            REMINDER_BATCH_SIZE,
+            start_cursor=get_cursor(self.request.get('cursor')))
+        for user in users:
+            if not user.email:
+                continue
+            subject = 'This is a reminder!'
+            body = 'Hello {}, you have at least one active ' \
+                'hangman game!'.format(user.name)
+            # This will send test emails,
+            # the arguments to send_mail are:
+            # from, to, subject, body
+            mail.send_mail('noreply@{}.appspotmail.com'.format(app_id),
+                           user.email,
+                           subject,
+                           body)
+        if more:
+            _enqueue_reminders(run, batch + 1, cursor)
+
+
+def _enqueue_batch(url, prefix, day, batch, cursor=None):
+    """Adds the task for one batch of a day's rollup or archive chain, named
+    so that a batch is never enqueued twice"""
+    params = {'day': day.isoformat(), 'batch': batch}
+    if cursor:
+        params['cursor'] = cursor.urlsafe()
+    try:
+        taskqueue.add(url=url, params=params,
+                      name='{}-{}-{}'.format(prefix, day.isoformat(), batch))
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+def _parse_day(value):
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+
+class RollupScoresCron(webapp2.RequestHandler):
+    @instrumented('cron.rollup_scores')
+    def get(self):
+        """
+        Start rolling up the Scores of every finished day not yet rolled up.
+        Called every 24 hours using a cron job; the work is done by a chain
+        of RollupScores tasks, one day after another
+        """
+        last_day = ScoreRollup.get_last_day()
+        if last_day:
+            day = last_day + timedelta(days=1)
+        else:
+            first = Score.query().order(Score.date).get()
+            if not first:
+                return
+            day = first.date
+        if day < date.today():
+            _enqueue_batch('/tasks/rollup_scores', 'rollup', day, 0)
+
+
+class RollupScores(webapp2.RequestHandler):
+    @instrumented('task.rollup_scores')
+    def post(self):
+        """
+        Add one batch of a day's Scores to DailyScores, then enqueue the next
+        batch. After the last batch the day is marked rolled up, its Scores
+        are archived if ARCHIVE_SCORES is set, and the next day is started
+        if it has finished.
+        """
+        day = _parse_day(self.request.get('day'))
+        batch = int(self.request.get('batch'))
+        scores, cursor, more = Score.query(Score.date == day).fetch_page(
+            ROLLUP_BATCH_SIZE,
+            start_cursor=get_cursor(self.request.get('cursor')))
+        DailyScore.add_scores(day, batch, scores)
+        if more:
+            _enqueue_batch('/tasks/rollup_scores', 'rollup', day, batch + 1,
+                           cursor)
+            return
+        ScoreRollup.finish_day(day)
+        if ARCHIVE_SCORES:
+            _enqueue_batch('/tasks/archive_scores', 'archive', day, 0)
+        next_day = day + timedelta(days=1)
+        if next_day < date.today():
+            _enqueue_batch('/tasks/rollup_scores', 'rollup', next_day, 0)
+
+
+class ArchiveScores(webapp2.RequestHandler):
+    @instrumented('task.archive_scores')
+    def post(self):
+        """
+        Delete one batch of the Scores of a day that has been rolled up,
+        then enqueue the next batch. Each batch deletes what it reads, so it
+        starts from the beginning of the day rather than from a cursor.
+        """
+        day = _parse_day(self.request.get('day'))
+        batch = int(self.request.get('batch'))
+        keys = Score.query(Score.date == day).fetch(ROLLUP_BATCH_SIZE,
+                                                     keys_only=True)
+        ndb.delete_multi(keys)
+        if len(keys) == ROLLUP_BATCH_SIZE:
+            _enqueue_batch('/tasks/archive_scores', 'archive', day,
+                           batch + 1)
+
+
+def _enqueue_run_batch(url, run, batch, cursor):
+    """Adds the task for one batch of an admin run, named so that a batch is
+    never enqueued twice"""
+    try:
+        taskqueue.add(url=url,
+                      params={'run': run, 'batch': batch,
+                              'cursor': cursor.urlsafe()},
+                      name='{}-{}'.format(run, batch))
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+class IndexActiveGames(webapp2.RequestHandler):
+    @instrumented('task.index_active_games')
+    def post(self):
+        """
+        Add one batch of active games to their Users' active games and to
+        the active game counters, then enqueue the next batch. Needed once,
+        for games created before Users kept their active games and before
+        the counters existed.
+        """
+        run = self.request.get('run')
+        batch = int(self.request.get('batch'))
+        keys, cursor, more = Game.query(Game.game_over == False).fetch_page(
+            INDEX_BATCH_SIZE, keys_only=True,
+            start_cursor=get_cursor(self.request.get('cursor')))
+        games = ndb.get_multi(keys)
+        by_user = {}
+        for game in games:
+            if game:
+                by_user.setdefault(game.user, []).append(game.key)
+        futures = []
+        for user_key, game_keys in by_user.items():
+            for i in range(0, len(game_keys), INDEX_TXN_SIZE):
+                futures.append(User.add_active_games_async(
+                    user_key, game_keys[i:i + INDEX_TXN_SIZE], verify=True))
+        for future in futures:
+            future.check_success()
+        uncounted = [game.key for game in games if game and not game.counted]
+        # One at a time, as each transaction writes a counter shard
+        for i in range(0, len(uncounted), COUNT_TXN_SIZE):
+            Game.add_to_counters(uncounted[i:i + COUNT_TXN_SIZE])
+        if more:
+            _enqueue_run_batch('/tasks/index_active_games', run, batch + 1,
+                               cursor)
+
+
+class RebuildUserTotals(webapp2.RequestHandler):
+    @instrumented('task.rebuild_user_totals')
+    def post(self):
+        """
+        Recompute one batch of Users' totals from their finished Games, then
+        enqueue the next batch. Needed once, for users whose games finished
+        before the totals were kept.
+        """
+        run = self.request.get('run')
+        batch = int(self.request.get('batch'))
+        keys, cursor, more = User.query().fetch_page(
+            TOTALS_BATCH_SIZE, keys_only=True,
+            start_cursor=get_cursor(self.request.get('cursor')))
+        queries = [Game.query(Game.user == key,
+                              Game.game_over == True).fetch_async()
+                   for key in keys]
+        futures = [User.rebuild_totals_async(key, query.get_result())
+                   for key, query in zip(keys, queries)]
+        for future in futures:
+            future.check_success()
+        if more:
+            _enqueue_run_batch('/tasks/rebuild_user_totals', run, batch + 1,
+                               cursor)
+
+
+class RecordGameEnd(webapp2.RequestHandler):
+    @instrumented('task.record_game_end')
+    def post(self):
+        """Add a finished game to its User's totals and the leaderboard."""
+        score = self.request.get('score')
+        Game.record_end(ndb.Key(urlsafe=self.request.get('game')),
+                        ndb.Key(urlsafe=score) if score else None)
+        self.response.set_status(204)
 
 
 class UpdateAverageMovesRemaining(webapp2.RequestHandler):
+    @instrumented('task.cache_average_attempts')
     def post(self):
         """Update game listing announcement in memcache."""
         HangmanApi._cache_average_attempts()
         self.response.set_status(204)
 
 
+class RebuildLeaderboard(webapp2.RequestHandler):
+    @instrumented('task.rebuild_leaderboard')
+    def post(self):
+        """Recreate the leaderboard from the Score table."""
+        Leaderboard.rebuild()
+        self.response.set_status(204)
+
+
+class ExportBatch(webapp2.RequestHandler):
+    @instrumented('task.export')
+    def post(self):
+        """Export one batch of a kind, then enqueue the next."""
+        bulk.export_batch(self.request.get('run'),
+                          self.request.get('export_id'),
+                          self.request.get('kind'),
+                          int(self.request.get('batch')),
+                          get_cursor(self.request.get('cursor')))
+
+
+class ImportBatch(webapp2.RequestHandler):
+    @instrumented('task.import')
+    def post(self):
+        """Import one part file of a kind, then enqueue the next."""
+        bulk.import_batch(self.request.get('run'),
+                          self.request.get('export_id'),
+                          self.request.get('kind'),
+                          int(self.request.get('batch')))
+
+
+class WarmUp(webapp2.RequestHandler):
+    @instrumented('warmup')
+    def get(self):
+        """Build the hint index before the instance serves requests."""
+        hints.get_index()
+        self.response.set_status(200)
+
+
 app = webapp2.WSGIApplication([
+    ('/_ah/warmup', WarmUp),
     ('/crons/send_reminder', SendReminderEmail),
+    ('/crons/rollup_scores', RollupScoresCron),
     ('/tasks/cache_average_attempts', UpdateAverageMovesRemaining),
+    ('/tasks/send_reminders', SendReminderBatch),
+    ('/tasks/rebuild_leaderboard', RebuildLeaderboard),
+    ('/tasks/record_game_end', RecordGameEnd),
+    ('/tasks/rollup_scores', RollupScores),
+    ('/tasks/archive_scores', ArchiveScores),
+    ('/tasks/export', ExportBatch),
+    ('/tasks/index_active_games', IndexActiveGames),
+    ('/tasks/rebuild_user_totals', RebuildUserTotals),
+    ('/tasks/import', ImportBatch),
 ], debug=True)
@@ -1,123 +1,604 @@
 import random
+import time
+from bisect import bisect_right
 from datetime import date
+from itertools import ifilter, islice
 from protorpc import messages
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
 from google.appengine.ext import ndb
 
+import cache
+import counters
+import engine
+from utils import transaction_with_backoff_async
+
+# Sharded counters over all active games, used for the average attempts
+# remaining
+ACTIVE_GAMES = 'active_games'
+ATTEMPTS_REMAINING = 'attempts_remaining'
+# Games written in each cross-group transaction with the two counter shards
+COUNT_TXN_SIZE = 23
+
+MEMCACHE_LEADERBOARD = 'LEADERBOARD'
+LEADERBOARD_SIZE = 100
+# Seconds the leaderboard is kept in memcache, which bounds how long a copy
+# cached just before a new score was added can be served
+LEADERBOARD_CACHE_TTL = 60
+# Whether the daily rollup deletes Scores once they are in DailyScores
+ARCHIVE_SCORES = False
+# Results kept on a Game for moves sent with an idempotency key
+MOVE_RESULTS_KEPT = 20
+# Times a move's transaction is run before giving up, and the most seconds
+# waited before the first retry
+MOVE_ATTEMPTS = 4
+MOVE_RETRY_DELAY = 0.05
+
+
+class StaleMoveError(Exception):
+    """Raised for a move made against a move_seq the game has moved past"""
+
 
 class User(ndb.Model):
     """User profile"""
     name = ndb.StringProperty(required=True)
     email = ndb.StringProperty()
-    rating = ndb.IntegerProperty()
+    # Running totals over the user's finished games, maintained by
+    # Game.end_game and Game.cancel_game
+    total_guesses = ndb.IntegerProperty(default=0)
+    games_won = ndb.IntegerProperty(default=0)
+    games_lost = ndb.IntegerProperty(default=0)
+    rating = ndb.ComputedProperty(lambda self: self._rating())
+    # Keys of the user's unfinished games, sorted so that pages can resume
+    # after a key, maintained in transactions by Game.new_games, end_game and
+    # cancel_game
+    active_games = ndb.KeyProperty(kind='Game', repeated=True, indexed=False)
+    has_active_games = ndb.ComputedProperty(
+        lambda self: bool(self.active_games))
 
     def to_form(self):
         return RankingForm(user_name=self.name,
                            rating=self.rating)
 
-    def update_rating(self, games):
+    @classmethod
+    def get_by_names(cls, names):
+        """Returns a dict of name to User for those names that exist. ndb
+        runs an IN filter as one query per value, run in parallel, so this
+        costs one RunQuery per distinct name"""
+        names = list(set(names))
+        users = {}
+        # Datastore IN filters take at most 30 values
+        for i in range(0, len(names), 30):
+            for user in cls.query(cls.name.IN(names[i:i + 30])):
+                users[user.name] = user
+        return users
+
+    def _rating(self):
         """
         Creates a player rating normalizing the number of games
         Golf rules: lower the score the better
         There is an additional 3 point penalty for games lost
         Players with no games won are unrated with rating -1
         """
-        guesses = 0
-        gamesWon = 0
-        gamesLost = 0
+        if self.games_won:
+            return self.total_guesses / self.games_won + 3 * self.games_lost
+        return -1
+
+    def record_game(self, game_key, guesses, won=False, cancelled=False):
+        """Adds a finished game to the user's totals and drops it from the
+        active games"""
+        self.total_guesses += guesses
+        if won:
+            self.games_won += 1
+        elif not cancelled:
+            self.games_lost += 1
+        if game_key in self.active_games:
+            self.active_games.remove(game_key)
+
+    @classmethod
+    @ndb.transactional_tasklet
+    def rebuild_totals_async(cls, user_key, games):
+        """Sets the user's totals to those of the given finished games,
+        returning a Future. Putting the User also re-indexes its rating"""
+        user = yield user_key.get_async()
+        if not user:
+            return
+        user.total_guesses = user.games_won = user.games_lost = 0
         for game in games:
-            guesses = guesses + game.attempts_allowed - game.attempts_remaining
-            if game.game_over and not game.cancelled and \
-                    game.attempts_remaining > 0:
-                gamesWon = gamesWon + 1
-            if game.attempts_remaining == game.attempts_allowed:
-                gamesLost = gamesLost + 1
-
-        if gamesWon:
-            self.rating = guesses / gamesWon + (3 * gamesLost)
+            # A game is lost once it runs out of attempts
+            won = not game.cancelled and game.attempts_remaining > 0
+            user.record_game(game.key,
+                             game.attempts_allowed - game.attempts_remaining,
+                             won=won, cancelled=game.cancelled)
+        yield user.put_async()
+
+    @classmethod
+    @ndb.transactional_tasklet(xg=True)
+    def add_active_games_async(cls, user_key, game_keys, verify=False):
+        """Adds games to a user's active games, returning a Future. With
+        verify, games that are over or missing are left out; the games are
+        read in the same cross-group transaction, so pass at most 24"""
+        if verify:
+            user, games = yield (user_key.get_async(),
+                                 ndb.get_multi_async(game_keys))
+            game_keys = [game.key for game in games
+                         if game and not game.game_over]
         else:
-            self.rating = -1
-        self.put()
+            user = yield user_key.get_async()
+        if not user:
+            return
+        user.active_games = sorted(set(user.active_games) | set(game_keys))
+        yield user.put_async()
+
+    @classmethod
+    @ndb.transactional
+    def remove_active_games(cls, user_key, game_keys):
+        user = user_key.get()
+        user.active_games = [key for key in user.active_games
+                             if key not in game_keys]
+        user.put()
+
+
+def prefetch_user_names(entities):
+    """Fills in user_name on Games or Scores saved before the name was
+    stored on them, resolving all of their users with a single get_multi
+    call. The users also land in ndb's request-scoped context cache."""
+    missing = [entity for entity in entities if not entity.user_name]
+    if not missing:
+        return
+    users = ndb.get_multi(list(set(entity.user for entity in missing)))
+    names = dict((user.key, user.name) for user in users if user)
+    for entity in missing:
+        entity.user_name = names.get(entity.user)
 
 
 class Game(ndb.Model):
     """Game object"""
+    # Games are cached by cache.py, which keeps its own memcache copy
+    _use_entity_cache = True
+    _use_memcache = False
+    # Cleared by put_multi, which caches the whole batch at once
+    _cache_on_put = True
+
     answer = ndb.StringProperty(required=True)
     attempts_allowed = ndb.IntegerProperty(required=True)
     attempts_remaining = ndb.IntegerProperty(required=True)
     game_over = ndb.BooleanProperty(required=True, default=False)
     cancelled = ndb.BooleanProperty(required=True, default=False)
     user = ndb.KeyProperty(required=True, kind='User')
-    guess_field = ndb.StringProperty(required=True)
+    # Copy of the user's name, so that forms don't need to load the User
+    user_name = ndb.StringProperty(indexed=False)
+    # Guesses in the order they were made. Letters a-z among them are also
+    # set in the guessed_letters bitmask, so repeats are found without a scan
+    guesses = ndb.StringProperty(repeated=True, indexed=False)
+    guessed_letters = ndb.IntegerProperty(default=0, indexed=False)
+    # JSON list of guesses of games saved before guesses existed
     prev_guesses = ndb.JsonProperty()
+    # letter -> bitmask of its positions in answer, and the bitmask of
+    # positions guessed so far; guess_field is rendered from these
+    letter_positions = ndb.JsonProperty()
+    revealed = ndb.JsonProperty(default=0)
+    # Number of changes made to the game, bumped by every guess applied and
+    # by cancelling. Clients may send it back with a move to have the move
+    # refused if someone else has moved since
+    move_seq = ndb.IntegerProperty(default=0, indexed=False)
+    # The last MOVE_RESULTS_KEPT moves sent with an idempotency key, oldest
+    # first, each a dict of the key, the messages and the game's state after
+    # the move, so a retried request is answered without being applied again
+    move_results = ndb.JsonProperty(default=[])
+    # Whether the game is in the active game counters. Set on new games, and
+    # by add_to_counters for games created before the counters existed,
+    # whose moves leave the counters alone until then
+    counted = ndb.BooleanProperty(default=False, indexed=False)
+    # Whether the finished game has been added to its User's totals and its
+    # Score to the leaderboard, by the task enqueued when it ended
+    recorded = ndb.BooleanProperty(default=False, indexed=False)
+
+    def __init__(self, *args, **kwargs):
+        super(Game, self).__init__(*args, **kwargs)
+        # Unit of work for a single request: fields changed since the last
+        # write, entities (e.g. a Score) to be written alongside the game,
+        # whether the game has just ended, pending changes to the active game
+        # counters and the new Score for the leaderboard
+        self._dirty_fields = set()
+        self._staged = []
+        self._ended = False
+        self._counter_deltas = {}
+        self._score = None
+        # Guesses other than single letters a-z, built on first use
+        self._other_guesses = None
+
+    def _post_put_hook(self, future):
+        # Write-through, so cached copies never lag a successful put. Games
+        # put in a transaction are cached by move_seq, or dropped from the
+        # cache, once it commits
+        if (self._cache_on_put and future.get_exception() is None and
+                not ndb.in_transaction()):
+            cache.put(self)
 
     @classmethod
     def new_game(cls, user, answer, attempts):
-        """Creates and returns a new game"""
-        if len(answer) < 2:
-            raise ValueError('Answer must be more than one letter')
-        else:
-            guess_field = ''
-            for x in answer:
-                guess_field += '*'
-        game = Game(user=user,
-                    answer=answer,
-                    guess_field=guess_field,
-                    attempts_allowed=attempts,
-                    attempts_remaining=attempts,
-                    game_over=False,
-                    cancelled=False,
-                    prev_guesses=[])
-        game.put()
-        return game
+        """Creates and returns a new game for the given User"""
+        return cls.new_games([(user, answer, attempts)])[0]
+
+    @classmethod
+    def new_games(cls, specs):
+        """Creates and returns new games for a list of (User, answer,
+        attempts) tuples. Nothing is written if any answer is invalid;
+        otherwise the games are written COUNT_TXN_SIZE at a time, each batch
+        in one transaction with its addition to the active game counters,
+        the transactions running side by side"""
+        for user, answer, attempts in specs:
+            if len(answer) < 2:
+                raise ValueError('Answer must be more than one letter')
+        if not specs:
+            return []
+        first, _ = cls.allocate_ids(size=len(specs))
+        games = []
+        for i, (user, answer, attempts) in enumerate(specs):
+            games.append(Game(key=ndb.Key(cls, first + i),
+                              user=user.key,
+                              user_name=user.name,
+                              answer=answer,
+                              letter_positions=engine.letter_positions(answer),
+                              revealed=0,
+                              attempts_allowed=attempts,
+                              attempts_remaining=attempts,
+                              game_over=False,
+                              cancelled=False,
+                              counted=True))
+        # Each user's active games are updated first, in one transaction per
+        # user run side by side, so an indexed game key may point to a game
+        # not yet written but a written game is never missing from the index
+        by_user = {}
+        for game in games:
+            by_user.setdefault(game.user, []).append(game.key)
+        futures = [User.add_active_games_async(user_key, keys)
+                   for user_key, keys in by_user.items()]
+        for future in futures:
+            future.check_success()
+        futures = [cls._put_counted_async(games[i:i + COUNT_TXN_SIZE])
+                   for i in range(0, len(games), COUNT_TXN_SIZE)]
+        for future in futures:
+            future.check_success()
+        cache.put_multi(games)
+        return games
+
+    @classmethod
+    @ndb.transactional_tasklet(xg=True)
+    def _put_counted_async(cls, games):
+        """Writes new games and adds them to the active game counters, in
+        one transaction, so a game is counted if and only if it is saved"""
+        shards = yield counters.incremented_shards_async({
+            ACTIVE_GAMES: len(games),
+            ATTEMPTS_REMAINING: sum(game.attempts_allowed for game in games)})
+        yield ndb.put_multi_async(games + shards)
+
+    @classmethod
+    def put_multi(cls, games):
+        """Writes games outside a transaction with one put_multi call and
+        caches them with one memcache call, rather than one per game"""
+        for game in games:
+            game._cache_on_put = False
+        try:
+            ndb.put_multi(games)
+        finally:
+            for game in games:
+                del game._cache_on_put
+        cache.put_multi(games)
 
     def to_form(self, message):
         """Returns a GameForm representation of the Game"""
         form = GameForm()
         form.urlsafe_key = self.key.urlsafe()
-        form.user_name = self.user.get().name
+        form.user_name = self.get_user_name()
         form.attempts_remaining = self.attempts_remaining
         form.game_over = self.game_over
         form.cancelled = self.cancelled
         form.message = message
         form.guess_field = self.guess_field
+        form.move_seq = self.move_seq
         return form
 
     def to_history_form(self):
         """Returns history of game"""
         form = HistoryForm()
         form.urlsafe_key = self.key.urlsafe()
-        form.user_name = self.user.get().name
+        form.user_name = self.get_user_name()
         form.prev_guesses = GuessListForms(
             items=[self.to_prevguesses_form(guess)
-                   for guess in self.prev_guesses])
+                   for guess in self.guess_history()])
         return form
 
+    def get_user_name(self):
+        if not self.user_name:
+            prefetch_user_names([self])
+        return self.user_name
+
+    @ndb.tasklet
+    def get_user_name_async(self):
+        """Asynchronous version of get_user_name(), returning a Future"""
+        if not self.user_name:
+            user = yield self.user.get_async()
+            self.user_name = user.name if user else None
+        raise ndb.Return(self.user_name)
+
+    def guess_history(self):
+        """Returns the guesses made so far, oldest first"""
+        self._upgrade_guesses()
+        return self.guesses
+
     def to_prevguesses_form(self, guess):
         return GuessListForm(guess=guess)
 
-    def update_guess_field(self, new_guess_field):
-        self.guess_field = new_guess_field
-        self.put()
+    @property
+    def guess_field(self):
+        """The answer with every unrevealed letter shown as '*'"""
+        # Games saved before the index existed are brought up to date on
+        # first use; the changes are written with the game's next move
+        self._upgrade_guesses()
+        self._positions()
+        return engine.render(self.answer, self.revealed)
+
+    def _positions(self):
+        if self.letter_positions is None:
+            # Games created before the index existed
+            self.letter_positions = engine.letter_positions(self.answer)
+            for guess in self.guesses:
+                self.revealed |= self.letter_positions.get(guess, 0)
+            self._dirty_fields.update(['letter_positions', 'revealed'])
+        return self.letter_positions
+
+    def _upgrade_guesses(self):
+        """Moves the guesses of games saved before guesses existed out of
+        prev_guesses"""
+        if self.prev_guesses is None:
+            return
+        for guess in self.prev_guesses:
+            self.guesses.append(guess)
+            self.guessed_letters |= engine.letter_bit(guess)
+        self.prev_guesses = None
+        self._dirty_fields.update(['guesses', 'guessed_letters',
+                                   'prev_guesses'])
+
+    def already_guessed(self, guess):
+        bit = engine.letter_bit(guess)
+        if bit:
+            return bool(self.guessed_letters & bit)
+        if self._other_guesses is None:
+            self._other_guesses = set(g for g in self.guesses
+                                      if not engine.letter_bit(g))
+        return guess in self._other_guesses
 
     def add_to_guesslist(self, guess):
-        self.prev_guesses.append(guess)
+        self.guesses.append(guess)
+        self._dirty_fields.add('guesses')
+        bit = engine.letter_bit(guess)
+        if bit:
+            self.guessed_letters |= bit
+            self._dirty_fields.add('guessed_letters')
+        elif self._other_guesses is not None:
+            self._other_guesses.add(guess)
+
+    def _count(self, name, delta):
+        if self.counted:
+            self._counter_deltas[name] = (self._counter_deltas.get(name, 0) +
+                                          delta)
+
+    @classmethod
+    def add_to_counters(cls, keys):
+        """Adds those of the games that are active but not yet counted to
+        the active game counters. The games and a counter shard are written
+        in one cross-group transaction, so pass at most COUNT_TXN_SIZE keys;
+        a game is never counted twice"""
+        @ndb.transactional(xg=True)
+        def txn():
+            games = [game for game in ndb.get_multi(keys)
+                     if game and not game.game_over and not game.counted]
+            for game in games:
+                game.counted = True
+            shards = counters.incremented_shards_async({
+                ACTIVE_GAMES: len(games),
+                ATTEMPTS_REMAINING: sum(game.attempts_remaining
+                                        for game in games)}).get_result()
+            ndb.put_multi(games + shards)
+            return games
+        for game in txn():
+            cache.invalidate(game.key)
+
+    def _bump_move_seq(self):
+        self.move_seq += 1
+        self._dirty_fields.add('move_seq')
+
+    def _leave_active_games(self):
+        self._count(ACTIVE_GAMES, -1)
+        self._count(ATTEMPTS_REMAINING, -self.attempts_remaining)
+
+    def make_guess(self, guess):
+        """Applies a guess to the game and returns the message for the
+        player. Raises ValueError for a blank guess. Changes are written by
+        update_async()"""
+        if self.game_over:
+            return 'Game already over!'
+        self._upgrade_guesses()
+        # if a guess has already been made, the user will be alerted
+        # and will not be penalized a guess
+        if self.already_guessed(guess):
+            return engine.message(engine.REPEAT, guess, self.answer,
+                                  self.revealed)
+        outcome, revealed, attempts_remaining = engine.play(
+            self.answer, self._positions(), self.revealed,
+            self.attempts_remaining, guess)
+        self._bump_move_seq()
+        if revealed != self.revealed:
+            self.revealed = revealed
+            self._dirty_fields.add('revealed')
+        if attempts_remaining != self.attempts_remaining:
+            self._count(ATTEMPTS_REMAINING,
+                        attempts_remaining - self.attempts_remaining)
+            self.attempts_remaining = attempts_remaining
+            self._dirty_fields.add('attempts_remaining')
+        if outcome != engine.WIN:
+            self.add_to_guesslist(guess)
+        if outcome in (engine.WIN, engine.LOSE):
+            self.end_game(outcome == engine.WIN)
+        return engine.message(outcome, guess, self.answer, self.revealed)
 
     def end_game(self, won=False):
         """Ends the game - if won is True, the player won. - if won is False,
-        the player lost."""
+        the player lost. The game and its Score are written by
+        update_async()"""
         self.game_over = True
-        self.put()
+        self._dirty_fields.add('game_over')
+        self._leave_active_games()
+        guesses = self.attempts_allowed - self.attempts_remaining
         # Add the game to the score 'board'
-        score = Score(user=self.user, date=date.today(), won=won,
-                      guesses=self.attempts_allowed - self.attempts_remaining)
-        score.put()
+        score = Score(user=self.user, user_name=self.get_user_name(),
+                      date=date.today(), won=won, guesses=guesses)
+        self._ended = True
+        self._staged.append(score)
+        self._score = score
 
     def cancel_game(self):
         """Cancels the game - won is always False."""
         """Game is not added to the scoreboard"""
         self.game_over = True
         self.cancelled = True
-        self.put()
+        self._dirty_fields.update(['game_over', 'cancelled'])
+        self._bump_move_seq()
+        self._leave_active_games()
+        self._ended = True
+
+    @ndb.tasklet
+    def _put_async(self):
+        """Writes the game, if it has changed, together with any staged
+        entities and the changed counter shards in a single put_multi call.
+        Runs in update_async's transaction. Returns a Future for whether the
+        active game counters changed"""
+        entities = list(self._staged)
+        if self._dirty_fields:
+            entities.insert(0, self)
+        counters_changed = any(self._counter_deltas.values())
+        if counters_changed:
+            shards = yield counters.incremented_shards_async(
+                self._counter_deltas)
+            entities.extend(shards)
+        self._dirty_fields.clear()
+        self._staged = []
+        self._counter_deltas = {}
+        yield ndb.put_multi_async(entities)
+        raise ndb.Return(counters_changed)
+
+    def _enqueue_record_end(self):
+        """Enqueues record_end() for a game that has just ended. The task is
+        added in update_async's transaction, so it runs if and only if the
+        move commits"""
+        params = {'game': self.key.urlsafe()}
+        if self._score:
+            params['score'] = self._score.key.urlsafe()
+        taskqueue.add(url='/tasks/record_game_end', params=params,
+                      transactional=True)
+        self._ended = False
+        self._score = None
+
+    @classmethod
+    def record_end(cls, key, score_key=None):
+        """Adds a finished game to its User's totals and its Score, if any,
+        to the leaderboard, in one transaction that also sets the game's
+        recorded flag, so a task that runs twice changes nothing the second
+        time"""
+        @ndb.transactional(xg=True)
+        def txn():
+            game = key.get()
+            if not game or game.recorded:
+                return None
+            if score_key:
+                user, score = ndb.get_multi([game.user, score_key])
+            else:
+                user, score = game.user.get(), None
+            game.recorded = True
+            if user:
+                user.record_game(
+                    key, game.attempts_allowed - game.attempts_remaining,
+                    won=bool(score and score.won), cancelled=game.cancelled)
+            ndb.put_multi([entity for entity in (game, user) if entity])
+            if score:
+                Leaderboard.add_score(score)
+            return game
+
+        game = txn()
+        if game:
+            cache.invalidate(game.key)
+
+    @classmethod
+    @ndb.tasklet
+    def update_async(cls, key, update, idempotency_key=None, move_seq=None):
+        """Reads the game, calls update(game) and writes the game and its
+        Score, along with the active game counters, in one transaction, so
+        concurrent moves are applied one after the other and none is lost.
+        update returns a list of messages. Returns a Future for the game, the
+        messages and whether the active game counters changed. The game is
+        None if it does not exist.
+
+        A move sent again with the same idempotency_key gets the game and
+        messages as they were after the first one, and nothing is written.
+        With move_seq, the move is refused with StaleMoveError if the game
+        has changed since the client saw it. A transaction that conflicts is
+        retried MOVE_ATTEMPTS times with a growing random wait, and then
+        fails with TransactionFailedError. A move that ends the game also
+        enqueues, in the same transaction, the task that updates the user
+        totals and the leaderboard"""
+        @ndb.transactional_tasklet(retries=0, xg=True)
+        def txn():
+            game = yield key.get_async()
+            if not game:
+                raise ndb.Return((None, None, False, False))
+            if idempotency_key:
+                for result in game.move_results:
+                    if result['key'] == idempotency_key:
+                        game._restore(result)
+                        raise ndb.Return(
+                            (game, result['messages'], True, False))
+            if move_seq is not None and move_seq != game.move_seq:
+                raise StaleMoveError('The game has changed since move {}, '
+                                     'now at move {}'.format(move_seq,
+                                                             game.move_seq))
+            # Games saved before user_name was stored look it up for the
+            # form while the game is written
+            user = None if game.user_name else game.user.get_async()
+            results = update(game)
+            if idempotency_key and game._dirty_fields:
+                game._remember(idempotency_key, results)
+            if user:
+                counters_changed, user = yield game._put_async(), user
+                game.user_name = game.user_name or (user.name if user
+                                                    else None)
+            else:
+                counters_changed = yield game._put_async()
+            if game._ended:
+                game._enqueue_record_end()
+            raise ndb.Return((game, results, False, counters_changed))
+
+        game, results, replayed, counters_changed = \
+            yield transaction_with_backoff_async(
+                txn, attempts=MOVE_ATTEMPTS, delay=MOVE_RETRY_DELAY)
+        if game and not replayed:
+            cache.put_if_newer(game, lambda game: game.move_seq)
+        raise ndb.Return((game, results, counters_changed))
+
+    def _remember(self, idempotency_key, results):
+        result = {'key': idempotency_key, 'messages': results,
+                  'move_seq': self.move_seq, 'revealed': self.revealed,
+                  'attempts_remaining': self.attempts_remaining,
+                  'game_over': self.game_over, 'cancelled': self.cancelled}
+        self.move_results = (self.move_results + [result])[-MOVE_RESULTS_KEPT:]
+        self._dirty_fields.add('move_results')
+
+    def _restore(self, result):
+        """Sets the game back to its state after a remembered move"""
+        for name in ('move_seq', 'revealed', 'attempts_remaining',
+                     'game_over', 'cancelled'):
+            setattr(self, name, result[name])
 
 
 class Score(ndb.Model):
@@ -126,11 +607,233 @@ class Score(ndb.Model):
     date = ndb.DateProperty(required=True)
     won = ndb.BooleanProperty(required=True)
     guesses = ndb.IntegerProperty(required=True)
+    user_name = ndb.StringProperty(indexed=False)
 
     def to_form(self):
-        return ScoreForm(user_name=self.user.get().name, won=self.won,
+        return ScoreForm(user_name=self.get_user_name(), won=self.won,
                          date=str(self.date), guesses=self.guesses)
 
+    def get_user_name(self):
+        if not self.user_name:
+            prefetch_user_names([self])
+        return self.user_name
+
+
+class DailyScore(ndb.Model):
+    """Totals of one user's Scores for one day, compacted from Score by the
+    daily rollup. Stored under the User, keyed by date."""
+    date = ndb.DateProperty(required=True)
+    user_name = ndb.StringProperty(indexed=False)
+    games = ndb.IntegerProperty(default=0, indexed=False)
+    wins = ndb.IntegerProperty(default=0, indexed=False)
+    total_guesses = ndb.IntegerProperty(default=0, indexed=False)
+    best_guesses = ndb.IntegerProperty()
+    best_won = ndb.BooleanProperty(indexed=False)
+    # Rollup batches already counted, so a retried task counts none twice
+    batches = ndb.IntegerProperty(repeated=True, indexed=False)
+
+    @classmethod
+    def key_for(cls, user_key, day):
+        return ndb.Key(cls, day.isoformat(), parent=user_key)
+
+    def add(self, score):
+        self.games += 1
+        self.wins += int(score.won)
+        self.total_guesses += score.guesses
+        if self.best_guesses is None or score.guesses < self.best_guesses:
+            self.best_guesses = score.guesses
+            self.best_won = score.won
+
+    def merge(self, other):
+        self.games += other.games
+        self.wins += other.wins
+        self.total_guesses += other.total_guesses
+        if other.best_guesses is not None and (
+                self.best_guesses is None or
+                other.best_guesses < self.best_guesses):
+            self.best_guesses = other.best_guesses
+            self.best_won = other.best_won
+
+    @classmethod
+    def add_scores(cls, day, batch, scores):
+        """Adds one batch of a day's Scores to their users' DailyScores.
+        Those that already counted the batch are left alone"""
+        prefetch_user_names(scores)
+        by_key = {}
+        for score in scores:
+            by_key.setdefault(cls.key_for(score.user, day), []).append(score)
+        keys = list(by_key)
+        changed = []
+        for key, rollup in zip(keys, ndb.get_multi(keys)):
+            if rollup is None:
+                rollup = cls(key=key, date=day)
+            elif batch in rollup.batches:
+                continue
+            for score in by_key[key]:
+                rollup.user_name = score.user_name
+                rollup.add(score)
+            rollup.batches.append(batch)
+            changed.append(rollup)
+        ndb.put_multi(changed)
+
+    @classmethod
+    def totals_for(cls, user_key):
+        """Returns an unsaved DailyScore with the totals of all the user's
+        Scores, read from DailyScores for the days rolled up and from Score
+        for later days"""
+        last_day = ScoreRollup.get_last_day()
+        totals = cls()
+        scores = Score.query(Score.user == user_key)
+        if last_day:
+            for rollup in cls.query(ancestor=user_key):
+                # Skip a day the rollup is still working through
+                if rollup.date <= last_day:
+                    totals.merge(rollup)
+            scores = scores.filter(Score.date > last_day)
+        for score in scores:
+            totals.add(score)
+        return totals
+
+    def to_leaderboard_entry(self):
+        return [self.best_guesses, str(self.date), self.user_name,
+                self.best_won]
+
+    def to_stats_form(self, user_name):
+        return UserStatsForm(user_name=user_name, games=self.games,
+                             wins=self.wins, total_guesses=self.total_guesses,
+                             best_guesses=self.best_guesses)
+
+
+class ScoreRollup(ndb.Model):
+    """Progress of the daily rollup: the last day whose Scores have all been
+    added to DailyScores"""
+    last_day = ndb.DateProperty()
+
+    @classmethod
+    def _key(cls):
+        return ndb.Key(cls, 'global')
+
+    @classmethod
+    def get_last_day(cls):
+        rollup = cls._key().get()
+        return rollup.last_day if rollup else None
+
+    @classmethod
+    def finish_day(cls, day):
+        cls(key=cls._key(), last_day=day).put()
+
+
+class Leaderboard(ndb.Model):
+    """The LEADERBOARD_SIZE best scores, fewest guesses first, kept in one
+    entity (and in memcache) so the leaderboard never queries Score. Each
+    entry is [guesses, date, user_name, won]."""
+    entries = ndb.JsonProperty(default=[])
+
+    @classmethod
+    def _key(cls):
+        return ndb.Key(cls, 'global')
+
+    @classmethod
+    def get_entries(cls):
+        """Returns the leaderboard entries, or None if the leaderboard needs
+        to be rebuilt"""
+        entries = memcache.get(MEMCACHE_LEADERBOARD)
+        if entries is None:
+            board = cls._key().get()
+            if not board:
+                return None
+            entries = board.entries
+            memcache.set(MEMCACHE_LEADERBOARD, entries,
+                         time=LEADERBOARD_CACHE_TTL)
+        return entries
+
+    @staticmethod
+    def schedule_rebuild():
+        """Enqueues a rebuild of the leaderboard. Tasks are named after the
+        minute, so the task queue drops any duplicates"""
+        try:
+            taskqueue.add(url='/tasks/rebuild_leaderboard',
+                          name='rebuild-leaderboard-{}'.format(
+                              int(time.time()) // 60))
+        except (taskqueue.TaskAlreadyExistsError,
+                taskqueue.TombstonedTaskError):
+            pass
+
+    @staticmethod
+    def _qualifies(entries, guesses):
+        return len(entries) < LEADERBOARD_SIZE or guesses < entries[-1][0]
+
+    @classmethod
+    def add_score(cls, score):
+        """Inserts a new Score, evicting the worst entry if the board is
+        full. Scores that don't make the board cost one memcache read. If
+        the board does not exist yet, a rebuild is scheduled instead, which
+        picks up the new Score along with the earlier ones."""
+        cls.add_score_async(score).get_result()
+
+    @classmethod
+    @ndb.tasklet
+    def add_score_async(cls, score):
+        """Asynchronous version of add_score(), returning a Future"""
+        cached = memcache.get(MEMCACHE_LEADERBOARD)
+        if cached is not None and not cls._qualifies(cached, score.guesses):
+            return
+
+        @ndb.transactional_tasklet
+        def txn():
+            board = yield cls._key().get_async()
+            if not board:
+                raise ndb.Return(False)
+            if not cls._qualifies(board.entries, score.guesses):
+                raise ndb.Return(True)
+            # Ties keep their existing order, so earlier scores rank first
+            entries = list(board.entries)
+            position = bisect_right([entry[0] for entry in entries],
+                                    score.guesses)
+            entries.insert(position, [score.guesses, str(score.date),
+                                      score.user_name, score.won])
+            board.entries = entries[:LEADERBOARD_SIZE]
+            yield board.put_async()
+            raise ndb.Return(True)
+        if (yield txn()):
+            memcache.delete(MEMCACHE_LEADERBOARD)
+        else:
+            cls.schedule_rebuild()
+
+    @classmethod
+    def rebuild(cls):
+        """Recreates the leaderboard from the Score table. When Scores are
+        archived, days already rolled up are read from DailyScore instead,
+        with one entry per user and day"""
+        last_day = ScoreRollup.get_last_day() if ARCHIVE_SCORES else None
+        scores = cls._best(Score.query().order(Score.guesses),
+                           lambda score: not last_day or score.date > last_day)
+        prefetch_user_names(scores)
+        entries = [[score.guesses, str(score.date), score.user_name,
+                    score.won] for score in scores]
+        if last_day:
+            rollups = cls._best(
+                DailyScore.query().order(DailyScore.best_guesses),
+                lambda rollup: rollup.date <= last_day)
+            entries.extend(rollup.to_leaderboard_entry()
+                           for rollup in rollups)
+            entries.sort(key=lambda entry: entry[0])
+            del entries[LEADERBOARD_SIZE:]
+        cls(key=cls._key(), entries=entries).put()
+        memcache.delete(MEMCACHE_LEADERBOARD)
+
+    @staticmethod
+    def _best(query, keep):
+        """Returns the first LEADERBOARD_SIZE results of query that keep
+        accepts"""
+        return list(islice(ifilter(keep, query), LEADERBOARD_SIZE))
+
+    @staticmethod
+    def to_form(entry):
+        guesses, date, user_name, won = entry
+        return ScoreForm(user_name=user_name, date=date, won=won,
+                         guesses=guesses)
+
 
 class GameForm(messages.Message):
     """GameForm for outbound game state information"""
@@ -141,11 +844,13 @@ class GameForm(messages.Message):
     message = messages.StringField(5, required=True)
     user_name = messages.StringField(6, required=True)
     guess_field = messages.StringField(7, required=True)
+    move_seq = messages.IntegerField(8)
 
 
 class GameForms(messages.Message):
     """Return multiple GameForms"""
     items = messages.MessageField(GameForm, 1, repeated=True)
+    next_cursor = messages.StringField(2)
 
 
 class NewGameForm(messages.Message):
@@ -158,9 +863,29 @@ class NewGameForm(messages.Message):
     attempts = messages.IntegerField(3, default=9)
 
 
+class NewGamesForm(messages.Message):
+    """Used to create several new games at once"""
+    games = messages.MessageField(NewGameForm, 1, repeated=True)
+
+
 class MakeMoveForm(messages.Message):
     """Used to make a move in an existing game"""
     guess = messages.StringField(1, required=True)
+    idempotency_key = messages.StringField(2)
+    move_seq = messages.IntegerField(3)
+
+
+class MakeMovesForm(messages.Message):
+    """Used to make a sequence of moves in an existing game"""
+    guesses = messages.StringField(1, repeated=True)
+    idempotency_key = messages.StringField(2)
+    move_seq = messages.IntegerField(3)
+
+
+class MovesForm(messages.Message):
+    """MovesForm for the outcome of a sequence of moves"""
+    game = messages.MessageField(GameForm, 1, required=True)
+    results = messages.StringField(2, repeated=True)
 
 
 class ScoreForm(messages.Message):
@@ -174,6 +899,7 @@ class ScoreForm(messages.Message):
 class ScoreForms(messages.Message):
     """Return multiple ScoreForms"""
     items = messages.MessageField(ScoreForm, 1, repeated=True)
+    next_cursor = messages.StringField(2)
 
 
 class StringMessage(messages.Message):
@@ -190,6 +916,7 @@ class RankingForm(messages.Message):
 class RankingForms(messages.Message):
     """Return multiple RankingForms"""
     items = messages.MessageField(RankingForm, 1, repeated=True)
+    next_cursor = messages.StringField(2)
 
 
 class GuessListForm(messages.Message):
@@ -204,3 +931,37 @@ class HistoryForm(messages.Message):
     urlsafe_key = messages.StringField(1, required=True)
     user_name = messages.StringField(2, required=True)
     prev_guesses = messages.MessageField(GuessListForms, 3)
+
+
+class HintForm(messages.Message):
+    """HintForm for a suggested guess"""
+    urlsafe_key = messages.StringField(1, required=True)
+    letter = messages.StringField(2)
+    candidates = messages.IntegerField(3, required=True)
+
+
+class UserStatsForm(messages.Message):
+    """UserStatsForm for a user's totals over all finished games"""
+    user_name = messages.StringField(1, required=True)
+    games = messages.IntegerField(2, required=True)
+    wins = messages.IntegerField(3, required=True)
+    total_guesses = messages.IntegerField(4, required=True)
+    best_guesses = messages.IntegerField(5)
+
+
+class StatsForm(messages.Message):
+    """StatsForm for latency and datastore RPCs of an endpoint or handler.
+    Percentiles are bucket upper bounds, unset when above 10 seconds."""
+    name = messages.StringField(1, required=True)
+    calls = messages.IntegerField(2, required=True)
+    p50_ms = messages.IntegerField(3)
+    p95_ms = messages.IntegerField(4)
+    p99_ms = messages.IntegerField(5)
+    gets_per_call = messages.FloatField(6, required=True)
+    puts_per_call = messages.FloatField(7, required=True)
+    queries_per_call = messages.FloatField(8, required=True)
+
+
+class StatsForms(messages.Message):
+    """Return multiple StatsForms"""
+    items = messages.MessageField(StatsForm, 1, repeated=True)
@@ -0,0 +1 @@
+"""tests - Unit tests, run against the in-memory fakes in benchmarks/fakes."""
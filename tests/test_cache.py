@@ -0,0 +1,101 @@
+"""test_cache.py - Tests for the Game cache staying behind the datastore,
+run against the in-memory fakes in benchmarks/fakes."""
+
+import unittest
+
+from benchmarks import fakes
+from benchmarks.harness import Client, Recorder, api
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.ext import ndb
+
+import cache
+import models
+
+# Put calls fail while this holds True
+_fail_puts = []
+
+
+def _fail_put(service, call, request, response):
+    if _fail_puts and service == 'datastore_v3' and call == 'Put':
+        raise RuntimeError('datastore unavailable')
+
+
+apiproxy_stub_map.apiproxy.GetPreCallHooks().Append('fail-put', _fail_put)
+
+
+class CacheTest(unittest.TestCase):
+    def setUp(self):
+        fakes.reset()
+        cache._entities.clear()
+        self.client = Client(Recorder())
+        self.client.call('create_user', api.USER_REQUEST, user_name=u'ann',
+                         email=u'ann@example.com')
+        game = self.client.call('new_game', api.NEW_GAME_REQUEST,
+                                user_name=u'ann', answer_word=u'abc',
+                                attempts=3)
+        self.key = game.urlsafe_key
+
+    def move(self, guess):
+        return self.client.call('make_move', api.MAKE_MOVE_REQUEST,
+                                urlsafe_game_key=self.key, guess=guess)
+
+    def get_game(self):
+        return self.client.call('get_game', api.GET_GAME_REQUEST,
+                                urlsafe_game_key=self.key)
+
+    def test_move_is_seen_by_next_read(self):
+        self.assertEqual(self.get_game().move_seq, 0)
+        self.move(u'x')
+        self.assertEqual(self.get_game().move_seq, 1)
+        self.move(u'y')
+        self.assertEqual(self.get_game().move_seq, 2)
+
+    def test_read_from_before_a_move_is_not_cached_after_it(self):
+        key = cache.decode_key(self.key)
+        before = key.get()
+        self.move(u'x')
+        cache.add(before)
+        self.assertEqual(cache.get(key).move_seq, 1)
+        self.assertEqual(self.get_game().move_seq, 1)
+
+    def test_older_commit_does_not_replace_newer(self):
+        self.move(u'x')
+        self.move(u'y')
+        key = cache.decode_key(self.key)
+        newer = key.get()
+        older = models.Game(**newer.to_dict())
+        older.key = key
+        older.move_seq = 1
+        version = lambda game: game.move_seq
+        cache.put_if_newer(newer, version)
+        cache.put_if_newer(older, version)
+        self.assertEqual(cache.get(key).move_seq, 2)
+        self.assertEqual(self.get_game().move_seq, 2)
+
+    def test_new_games_are_cached_with_one_call(self):
+        user = models.User.query().get()
+        sets = fakes.services.rpc_counts.get(('memcache', 'Set'), 0)
+        games = models.Game.new_games([(user, u'abc', 3)] * 10)
+        self.assertEqual(
+            fakes.services.rpc_counts.get(('memcache', 'Set'), 0) - sets, 1)
+        cache._entities.clear()
+        for game in games:
+            self.assertEqual(cache.get(game.key).answer, u'abc')
+
+    def test_failed_put_caches_nothing(self):
+        user = models.User.query().get()
+        game = models.Game(key=ndb.Key(models.Game, 'unsaved'), user=user.key,
+                           answer=u'abc', attempts_allowed=3,
+                           attempts_remaining=3)
+        _fail_puts.append(True)
+        try:
+            self.assertRaises(RuntimeError, game.put)
+        finally:
+            del _fail_puts[:]
+        self.assertIsNone(game.key.get())
+        self.assertIsNone(cache.get(game.key))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+"""test_counters.py - Tests for the active game counters matching the active
+games, run against the in-memory fakes in benchmarks/fakes."""
+
+import unittest
+
+from benchmarks import fakes
+from benchmarks.harness import Client, Recorder, api
+
+from google.appengine.api import apiproxy_stub_map
+
+import counters
+import models
+
+# Number of further Put calls allowed before they fail, or None
+_puts_left = [None]
+
+
+def _fail_put(service, call, request, response):
+    if service == 'datastore_v3' and call == 'Put' and \
+            _puts_left[0] is not None:
+        if not _puts_left[0]:
+            raise RuntimeError('instance shut down')
+        _puts_left[0] -= 1
+
+
+apiproxy_stub_map.apiproxy.GetPreCallHooks().Append('fail-after', _fail_put)
+
+
+class CounterTest(unittest.TestCase):
+    def setUp(self):
+        fakes.reset()
+        self.client = Client(Recorder())
+        self.client.call('create_user', api.USER_REQUEST, user_name=u'ann',
+                         email=u'ann@example.com')
+        self.user = models.User.query().get()
+
+    def assertCountsMatchGames(self):
+        games = models.Game.query(models.Game.game_over == False).fetch()
+        self.assertEqual(
+            counters.get_counts([models.ACTIVE_GAMES,
+                                 models.ATTEMPTS_REMAINING]),
+            {models.ACTIVE_GAMES: len(games),
+             models.ATTEMPTS_REMAINING: sum(game.attempts_remaining
+                                            for game in games)})
+
+    def test_new_games_failing_partway_are_counted_if_saved(self):
+        specs = [(self.user, u'abc', 3)] * (models.COUNT_TXN_SIZE * 2 + 1)
+        # The User's active games, then the first batch of games
+        _puts_left[0] = 2
+        try:
+            self.assertRaises(RuntimeError, models.Game.new_games, specs)
+        finally:
+            _puts_left[0] = None
+        self.assertEqual(models.Game.query().count(), models.COUNT_TXN_SIZE)
+        self.assertCountsMatchGames()
+
+    def test_moves_and_cancels_keep_counts(self):
+        games = models.Game.new_games([(self.user, u'abc', 3)] * 3)
+        keys = [game.key.urlsafe() for game in games]
+        for guess in (u'x', u'a', u'y'):
+            self.client.call('make_move', api.MAKE_MOVE_REQUEST,
+                             urlsafe_game_key=keys[0], guess=guess)
+        self.client.call('make_move', api.MAKE_MOVE_REQUEST,
+                         urlsafe_game_key=keys[1], guess=u'abc')
+        self.client.call('cancel_game', api.GET_GAME_REQUEST,
+                         urlsafe_game_key=keys[2])
+        self.assertCountsMatchGames()
+        self.assertEqual(counters.get_counts([models.ACTIVE_GAMES]),
+                         {models.ACTIVE_GAMES: 1})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+"""test_engine.py - Tests for the Hangman rules in engine.py."""
+
+import unittest
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import engine
+
+
+class PlayTest(unittest.TestCase):
+    def play(self, answer, revealed, attempts, guess):
+        return engine.play(answer, engine.letter_positions(answer), revealed,
+                           attempts, guess)
+
+    def test_letter_positions(self):
+        self.assertEqual(engine.letter_positions(u'hello'),
+                         {u'h': 1, u'e': 2, u'l': 12, u'o': 16})
+
+    def test_render(self):
+        self.assertEqual(engine.render(u'hello', 0), u'*****')
+        self.assertEqual(engine.render(u'hello', 12), u'**ll*')
+        self.assertEqual(engine.render(u'hello', 31), u'hello')
+
+    def test_hit_reveals_every_position(self):
+        self.assertEqual(self.play(u'hello', 0, 3, u'l'),
+                         (engine.HIT, 12, 3))
+
+    def test_miss_costs_an_attempt(self):
+        self.assertEqual(self.play(u'hello', 12, 3, u'z'),
+                         (engine.MISS, 12, 2))
+        self.assertEqual(self.play(u'hello', 12, 3, u'jelly'),
+                         (engine.MISS, 12, 2))
+
+    def test_last_miss_loses(self):
+        self.assertEqual(self.play(u'hello', 12, 1, u'z'),
+                         (engine.LOSE, 12, 0))
+
+    def test_last_letter_or_whole_word_wins(self):
+        self.assertEqual(self.play(u'hello', 29, 2, u'e'),
+                         (engine.WIN, 31, 2))
+        self.assertEqual(self.play(u'hello', 0, 2, u'hello'),
+                         (engine.WIN, 0, 2))
+
+    def test_blank_guess_is_refused(self):
+        self.assertRaises(ValueError, self.play, u'hello', 0, 3, u'')
+
+    def test_message(self):
+        self.assertEqual(engine.message(engine.HIT, u'l', u'hello', 12),
+                         u'You got one! Keep guessing: **ll*')
+        self.assertEqual(engine.message(engine.WIN, u'hello', u'hello', 0),
+                         u'Hooray! You win! The answer is: hello')
+
+
+@unittest.skipUnless(numpy, 'simulate() needs NumPy')
+class SimulateTest(unittest.TestCase):
+    def setUp(self):
+        self.result = engine.simulate(
+            [u'ab', u'zz'], [engine.ALPHABET, engine.ALPHABET[::-1]])
+
+    def test_misses_and_turns(self):
+        self.assertEqual(self.result.misses.tolist(), [[0, 24], [25, 0]])
+        self.assertEqual(self.result.turns.tolist(), [[2, 26], [26, 1]])
+
+    def test_rates_for_any_number_of_attempts(self):
+        self.assertEqual(self.result.win_rate(5).tolist(), [0.5, 0.5])
+        self.assertEqual(self.result.guesses_used(5).tolist(), [2.5, 2.5])
+        self.assertEqual(self.result.overall_win_rate(26), 1.0)
+
+    def test_strategy_running_out_of_letters_loses(self):
+        result = engine.simulate([u'zz'], [u'ab'])
+        self.assertEqual(result.misses[0, 0], result.UNSOLVED)
+        self.assertFalse(result.wins(26)[0, 0])
+
+    def test_invalid_answer_is_refused(self):
+        self.assertRaises(ValueError, engine.simulate, [u'a'], [u'ab'])
+        self.assertRaises(ValueError, engine.simulate, [u'Ab'], [u'ab'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+"""test_hints.py - Tests for the word index behind get_hint."""
+
+import unittest
+
+from benchmarks import fakes
+
+fakes.install()
+
+import hints  # noqa: E402
+
+WORDS = [u'hello', u'hallo', u'hullo', u'jelly', u'lolly', u'cat', u'a',
+         u'Bad']
+
+
+class WordIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = hints.WordIndex(WORDS)
+
+    def candidates(self, pattern, guesses):
+        bitset = self.index.candidates(pattern, guesses)
+        return sorted(word for i, word in
+                      enumerate(self.index.words.get(len(pattern), []))
+                      if bitset >> i & 1)
+
+    def test_skips_short_and_invalid_words(self):
+        self.assertEqual(sorted(self.index.words), [3, 5])
+        self.assertEqual(self.index.words[3], [u'cat'])
+
+    def test_candidates_fit_revealed_letters(self):
+        self.assertEqual(self.candidates(u'h*llo', [u'l']),
+                         [u'hallo', u'hello', u'hullo'])
+
+    def test_candidates_have_no_missed_letters(self):
+        self.assertEqual(self.candidates(u'h*llo', [u'l', u'e']),
+                         [u'hallo', u'hullo'])
+
+    def test_guessed_letters_are_revealed_everywhere(self):
+        # lolly has an l at the first position, which would be shown
+        self.assertEqual(self.candidates(u'**ll*', [u'l']),
+                         [u'hallo', u'hello', u'hullo', u'jelly'])
+
+    def test_wrong_word_guesses_are_left_out(self):
+        self.assertEqual(self.candidates(u'h*llo', [u'l', u'hallo']),
+                         [u'hello', u'hullo'])
+
+    def test_no_words_of_that_length(self):
+        self.assertEqual(self.index.candidates(u'****', []), 0)
+
+    def test_hint_picks_letter_in_most_candidates(self):
+        # h and o are each in three words; o is the more frequent letter
+        self.assertEqual(self.index.hint(u'**ll*', [u'l']), (u'o', 4))
+
+    def test_hint_without_candidates_is_most_frequent_letter(self):
+        self.assertEqual(self.index.hint(u'q****', []), (u'e', 0))
+
+    def test_no_hint_once_every_letter_is_guessed(self):
+        self.assertEqual(self.index.hint(u'**ll*', list(u'abcdefghijklm'
+                                                        u'nopqrstuvwxyz')),
+                         (None, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+"""test_instrumentation.py - Tests for the stats get_stats reports, run
+against the in-memory fakes in benchmarks/fakes."""
+
+import unittest
+
+from benchmarks import fakes
+from benchmarks.harness import Client, Recorder
+
+import instrumentation
+
+
+class StatsTest(unittest.TestCase):
+    def setUp(self):
+        fakes.reset()
+        instrumentation.flush()
+        self.client = Client(Recorder())
+
+    def names(self):
+        return [stats['name'] for stats in instrumentation.get_stats()]
+
+    def test_reports_handlers_run_on_other_instances(self):
+        self.client.handler('/tasks/cache_average_attempts', 'post')
+        self.client.handler('/_ah/warmup')
+        instrumentation.flush()
+        # An instance serving only the API has not imported main.py
+        names = instrumentation._names
+        self.addCleanup(setattr, instrumentation, '_names', names)
+        instrumentation._names = [name for name in names
+                                  if not name.startswith(('task.', 'cron.'))
+                                  and name != 'warmup']
+        self.assertIn('task.cache_average_attempts', self.names())
+        self.assertIn('warmup', self.names())
+
+    def test_registers_names_again_after_eviction(self):
+        self.client.handler('/tasks/cache_average_attempts', 'post')
+        instrumentation.flush()
+        fakes.services.memcache.delete(instrumentation.MEMCACHE_PREFIX +
+                                       instrumentation.NAMES_KEY)
+        self.client.handler('/_ah/warmup')
+        instrumentation.flush()
+        registered = fakes.services.memcache.get(
+            instrumentation.MEMCACHE_PREFIX + instrumentation.NAMES_KEY)
+        self.assertEqual(registered, ['warmup'])
+        self.assertIn('warmup', self.names())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,170 @@
+"""test_moves.py - Tests for repeated, stale and conflicting moves, run
+against the in-memory fakes in benchmarks/fakes."""
+
+import threading
+import unittest
+
+from benchmarks import fakes
+from benchmarks.harness import Client, Recorder, api
+
+import endpoints
+import models
+from benchmarks.fakes import services
+
+
+class MoveTest(unittest.TestCase):
+    def setUp(self):
+        fakes.reset()
+        self.client = Client(Recorder())
+        self.client.call('create_user', api.USER_REQUEST, user_name=u'ann',
+                         email=u'ann@example.com')
+        game = self.client.call('new_game', api.NEW_GAME_REQUEST,
+                                user_name=u'ann', answer_word=u'abc',
+                                attempts=3)
+        self.key = game.urlsafe_key
+        self.client.run_tasks()
+
+    def move(self, guess, **fields):
+        return self.client.call('make_move', api.MAKE_MOVE_REQUEST,
+                                urlsafe_game_key=self.key, guess=guess,
+                                **fields)
+
+    def get_game(self):
+        return self.client.call('get_game', api.GET_GAME_REQUEST,
+                                urlsafe_game_key=self.key)
+
+    def get_user(self):
+        return models.User.query(models.User.name == u'ann').get()
+
+    def patch(self, owner, name, value):
+        self.addCleanup(setattr, owner, name, getattr(owner, name))
+        setattr(owner, name, value)
+
+    def interfere(self, times):
+        """Makes the next times attempts at a guess conflict, by writing the
+        game from another request while the move's transaction is open.
+        Returns the list the number of attempts is counted in"""
+        attempts = []
+        make_guess = models.Game.make_guess
+
+        def conflicting_guess(game, guess):
+            attempts.append(guess)
+            if len(attempts) <= times:
+                writer = threading.Thread(target=lambda: game.key.get().put())
+                writer.start()
+                writer.join()
+            return make_guess(game, guess)
+        self.patch(models.Game, 'make_guess', conflicting_guess)
+        return attempts
+
+    def puts(self):
+        return services.rpc_counts.get(('datastore_v3', 'Put'), 0)
+
+    def test_replay_answers_without_applying_again(self):
+        first = self.move(u'x', idempotency_key=u'k1')
+        puts = self.puts()
+        replay = self.move(u'x', idempotency_key=u'k1')
+        self.assertEqual(self.puts(), puts)
+        self.assertEqual(replay.message, first.message)
+        self.assertEqual(replay.attempts_remaining, 2)
+        self.assertEqual(replay.move_seq, 1)
+        self.assertEqual(self.get_game().attempts_remaining, 2)
+
+    def test_replay_after_later_move_shows_state_after_first(self):
+        self.move(u'x', idempotency_key=u'k1')
+        self.move(u'y', idempotency_key=u'k2')
+        replay = self.move(u'x', idempotency_key=u'k1')
+        self.assertEqual(replay.attempts_remaining, 2)
+        self.assertEqual(replay.move_seq, 1)
+        self.assertEqual(self.get_game().attempts_remaining, 1)
+
+    def test_replayed_win_is_recorded_once(self):
+        self.move(u'abc', idempotency_key=u'win')
+        self.client.run_tasks()
+        replay = self.move(u'abc', idempotency_key=u'win')
+        self.client.run_tasks()
+        self.assertTrue(replay.game_over)
+        user = self.get_user()
+        self.assertEqual((user.games_won, user.games_lost), (1, 0))
+        self.assertEqual(user.active_games, [])
+        self.assertEqual(models.Score.query().count(), 1)
+        self.assertEqual(len(models.Leaderboard.get_entries()), 1)
+
+    def test_win_is_recorded_when_request_fails_after_commit(self):
+        put_if_newer = models.cache.put_if_newer
+
+        def fail(game, version):
+            raise RuntimeError('instance shut down')
+        models.cache.put_if_newer = fail
+        try:
+            self.assertRaises(RuntimeError, self.move, u'abc',
+                              idempotency_key=u'win')
+        finally:
+            models.cache.put_if_newer = put_if_newer
+        replay = self.move(u'abc', idempotency_key=u'win')
+        self.assertTrue(replay.game_over)
+        self.client.run_tasks()
+        user = self.get_user()
+        self.assertEqual((user.games_won, user.total_guesses), (1, 0))
+        self.assertEqual(user.active_games, [])
+
+    def test_record_end_task_run_twice_counts_once(self):
+        self.move(u'x')
+        self.move(u'abc')
+        tasks = services.taskqueue.pop_all()
+        self.assertEqual([task.url for task in tasks],
+                         ['/tasks/record_game_end'])
+        for _ in range(2):
+            self.client.handler(tasks[0].url, 'post', tasks[0].params)
+        self.client.run_tasks()
+        user = self.get_user()
+        self.assertEqual((user.games_won, user.total_guesses), (1, 1))
+        self.assertEqual(len(models.Leaderboard.get_entries()), 1)
+
+    def test_cancel_is_recorded_once(self):
+        self.move(u'x')
+        for _ in range(2):
+            self.client.call('cancel_game', api.GET_GAME_REQUEST,
+                             urlsafe_game_key=self.key)
+        self.client.run_tasks()
+        user = self.get_user()
+        self.assertEqual((user.games_won, user.games_lost,
+                          user.total_guesses), (0, 0, 1))
+        self.assertEqual(user.active_games, [])
+        self.assertEqual(models.Score.query().count(), 0)
+
+    def test_move_on_game_without_user_name_names_user(self):
+        game = models.cache.decode_key(self.key).get()
+        game.user_name = None
+        game.put()
+        result = self.move(u'x')
+        self.assertEqual(result.user_name, u'ann')
+        self.assertEqual(self.get_game().user_name, u'ann')
+
+    def test_stale_move_seq_is_refused(self):
+        self.assertEqual(self.move(u'x', move_seq=0).move_seq, 1)
+        self.assertRaises(endpoints.ConflictException, self.move, u'y',
+                          move_seq=0)
+        game = self.get_game()
+        self.assertEqual((game.move_seq, game.attempts_remaining), (1, 2))
+        self.assertEqual(self.move(u'y', move_seq=1).move_seq, 2)
+
+    def test_conflicting_move_is_retried(self):
+        attempts = self.interfere(models.MOVE_ATTEMPTS - 1)
+        result = self.move(u'x')
+        self.assertEqual(len(attempts), models.MOVE_ATTEMPTS)
+        self.assertEqual(result.attempts_remaining, 2)
+        self.assertEqual(self.get_game().move_seq, 1)
+
+    def test_move_fails_after_last_attempt_conflicts(self):
+        attempts = self.interfere(models.MOVE_ATTEMPTS)
+        self.assertRaises(endpoints.ConflictException, self.move, u'abc')
+        self.assertEqual(len(attempts), models.MOVE_ATTEMPTS)
+        game = self.get_game()
+        self.assertEqual((game.move_seq, game.game_over), (0, False))
+        self.assertEqual(services.taskqueue.pending, [])
+        self.assertEqual(models.Score.query().count(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+"""test_rollup.py - Tests for compacting Scores into DailyScores, run against
+the in-memory fakes in benchmarks/fakes."""
+
+import datetime
+import unittest
+
+from benchmarks import fakes
+
+fakes.install()
+
+import models  # noqa: E402
+
+DAY = datetime.date(2026, 1, 5)
+
+
+class AddScoresTest(unittest.TestCase):
+    def setUp(self):
+        fakes.reset()
+        self.ann = models.User(name=u'ann', email=u'ann@example.com')
+        self.bob = models.User(name=u'bob', email=u'bob@example.com')
+        models.ndb.put_multi([self.ann, self.bob])
+
+    def score(self, user, guesses, won):
+        return models.Score(user=user.key, user_name=user.name, date=DAY,
+                            guesses=guesses, won=won)
+
+    def rollup(self, user):
+        return models.DailyScore.key_for(user.key, DAY).get()
+
+    def test_adds_each_users_scores_to_their_day(self):
+        models.DailyScore.add_scores(DAY, 0, [
+            self.score(self.ann, 4, True), self.score(self.ann, 2, False),
+            self.score(self.bob, 6, True)])
+        ann = self.rollup(self.ann)
+        self.assertEqual((ann.games, ann.wins, ann.total_guesses),
+                         (2, 1, 6))
+        self.assertEqual((ann.best_guesses, ann.best_won), (2, False))
+        self.assertEqual((ann.user_name, ann.batches), (u'ann', [0]))
+        bob = self.rollup(self.bob)
+        self.assertEqual((bob.games, bob.wins, bob.best_guesses), (1, 1, 6))
+
+    def test_retried_batch_is_counted_once(self):
+        batch = [self.score(self.ann, 4, True)]
+        models.DailyScore.add_scores(DAY, 0, batch)
+        models.DailyScore.add_scores(DAY, 0, batch)
+        self.assertEqual(self.rollup(self.ann).games, 1)
+
+    def test_later_batches_are_added(self):
+        models.DailyScore.add_scores(DAY, 0, [self.score(self.ann, 4, True)])
+        models.DailyScore.add_scores(DAY, 1, [self.score(self.ann, 3, True),
+                                              self.score(self.bob, 5, False)])
+        models.DailyScore.add_scores(DAY, 1, [self.score(self.ann, 3, True),
+                                              self.score(self.bob, 5, False)])
+        ann = self.rollup(self.ann)
+        self.assertEqual((ann.games, ann.total_guesses, ann.best_guesses),
+                         (2, 7, 3))
+        self.assertEqual(ann.batches, [0, 1])
+        self.assertEqual(self.rollup(self.bob).games, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
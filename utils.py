@@ -1,14 +1,21 @@
 """utils.py - File for collecting general utility functions."""
 
 import logging
+import random
+from google.appengine.api import datastore_errors
 from google.appengine.ext import ndb
 import endpoints
 
+import cache
+
+
 def get_by_urlsafe(urlsafe, model):
     """Returns an ndb.Model entity that the urlsafe key points to. Checks
         that the type of entity returned is of the correct kind. Raises an
         error if the key String is malformed or the entity is of the incorrect
-        kind
+        kind. Models with _use_entity_cache set are read through cache.py,
+        and may then be up to cache.ENTITY_TTL seconds stale: don't put
+        them, but read the entity again in a transaction to change it
     Args:
         urlsafe: A urlsafe key string
         model: The expected entity kind
@@ -17,8 +24,22 @@ def get_by_urlsafe(urlsafe, model):
         exists.
     Raises:
         ValueError:"""
+    return get_by_urlsafe_async(urlsafe, model).get_result()
+
+
+def get_key(urlsafe, model):
+    """Returns the ndb.Key that the urlsafe key string points to, without
+    reading the entity. Raises BadRequestException if the string is
+    malformed and ValueError if the key is of the incorrect kind"""
+    key = _decode_key(urlsafe)
+    if key.kind() != model._get_kind():
+        raise ValueError('Incorrect Kind')
+    return key
+
+
+def _decode_key(urlsafe):
     try:
-        key = ndb.Key(urlsafe=urlsafe)
+        return cache.decode_key(urlsafe)
     except TypeError:
         raise endpoints.BadRequestException('Invalid Key')
     except Exception, e:
@@ -27,9 +48,73 @@ def get_by_urlsafe(urlsafe, model):
         else:
             raise
 
-    entity = key.get()
+
+@ndb.tasklet
+def get_by_urlsafe_async(urlsafe, model):
+    """Asynchronous version of get_by_urlsafe(), returning a Future"""
+    key = _decode_key(urlsafe)
+    use_cache = getattr(model, '_use_entity_cache', False)
+    entity = cache.get(key) if use_cache else None
+    if entity is None:
+        entity = yield key.get_async()
+        if entity is not None and use_cache:
+            cache.add(entity)
     if not entity:
-        return None
+        raise ndb.Return(None)
     if not isinstance(entity, model):
         raise ValueError('Incorrect Kind')
-    return entity
+    raise ndb.Return(entity)
+
+
+@ndb.tasklet
+def transaction_with_backoff_async(txn, attempts=4, delay=0.05):
+    """Runs a transactional tasklet until it commits, returning a Future
+    for its result
+    Args:
+        txn: A function decorated with ndb.transactional_tasklet(retries=0)
+        attempts: The most times txn is run
+        delay: The most seconds to wait before the second attempt, doubled
+            before each attempt after it. The wait is random up to that
+            bound, so clients that collided don't collide again
+    Raises:
+        TransactionFailedError: if the last attempt also conflicted."""
+    for attempt in range(attempts):
+        try:
+            result = yield txn()
+            raise ndb.Return(result)
+        except datastore_errors.TransactionFailedError:
+            if attempt == attempts - 1:
+                raise
+            logging.info('Transaction conflict, attempt %d', attempt + 1)
+            yield ndb.sleep(random.uniform(0, delay * 2 ** attempt))
+
+
+def get_cursor(urlsafe):
+    """Returns the query Cursor for a urlsafe cursor string
+    Args:
+        urlsafe: A urlsafe cursor string, as returned in next_cursor
+    Returns:
+        The Cursor, or None if no cursor string was given.
+    Raises:
+        BadRequestException: if the cursor string is malformed."""
+    if not urlsafe:
+        return None
+    try:
+        return ndb.Cursor(urlsafe=urlsafe)
+    except datastore_errors.BadValueError:
+        raise endpoints.BadRequestException('Invalid cursor')
+
+
+def fetch_page(query, page_size, urlsafe_cursor=None):
+    """Fetches one page of query results
+    Args:
+        query: The ndb Query to run
+        page_size: The maximum number of results to return
+        urlsafe_cursor: A urlsafe cursor string from a previous page, or None
+            for the first page
+    Returns:
+        A tuple of the results and the urlsafe cursor string for the next
+        page, which is None when there are no more results."""
+    results, cursor, more = query.fetch_page(
+        page_size, start_cursor=get_cursor(urlsafe_cursor))
+    return results, cursor.urlsafe() if more and cursor else None